@@ -5,6 +5,11 @@ import socket
 from datetime import datetime,date,time
 from time import sleep
 import subprocess
+import threading
+import queue
+import importlib.util
+import importlib.machinery
+import json
 from fpdf import FPDF 
 import tkinter as tk
 from tkinter import ttk
@@ -59,8 +64,9 @@ hostname = socket.gethostname()
 ghome    = os.getenv("HOME",None)
 path,macos = readconf()
 # Milliseconds
-afterwaittime=10000
-watchloopcount = 0
+afterwaittime=500
+# How often the panel looks for word from the search thread.
+pollwaittime=50
 targetdir = ''
 
 def findreturnedname(term,sa):
@@ -109,6 +115,271 @@ except:
     print("backup Failed log open ", logname)
     sys.exit(1)
 
+def loadsearchengine():
+    """Import searchgnucash so searches run in this process.
+    Returns the module, or None meaning run
+    ~/bin/searchgnucash as a separate program as before.
+    """
+    global sclog
+    try:
+        import searchgnucash
+        return searchgnucash
+    except ImportError:
+        pass
+    # Installed without the .py, so import it by path.
+    p = os.path.join(ghome,"bin/searchgnucash")
+    try:
+        loader = importlib.machinery.SourceFileLoader("searchgnucash",p)
+        spec = importlib.util.spec_from_loader("searchgnucash",loader)
+        m = importlib.util.module_from_spec(spec)
+        loader.exec_module(m)
+        return m
+    except (OSError,ImportError,SyntaxError) as message:
+        print("search: cannot import",p,message,curtime(),\
+            flush=True,file=sclog)
+        return None
+
+def progresstext(d):
+    """Words for a searchgnucash progress dict"""
+    phase = d.get("phase","")
+    if phase == "read":
+        return "Decompressed %.1f MB"%(d.get("bytes",0)/1000000.0)
+    if phase == "parse":
+        return "Read %d transactions"%(d.get("transactions",0))
+    if phase == "search":
+        return "Searched %d transactions, %d matches"%\
+            (d.get("transactions",0),d.get("matches",0))
+    if phase == "report":
+        return "Writing report of %d matches"%(d.get("matches",0))
+    return ""
+
+class linequeue:
+    """A file-like object for the report that passes each
+    batch of complete lines on as ("lines",[...])."""
+    def __init__(self,results):
+        self.results = results
+        self.partial = ""
+        self.lines = []
+
+    def write(self,s):
+        wds = (self.partial + s).split("\n")
+        self.partial = wds[-1]
+        self.lines += wds[:-1]
+        if len(self.lines) >= 200:
+            self.flush()
+        return len(s)
+
+    def flush(self):
+        if len(self.lines) > 0:
+            self.results.put(("lines",self.lines))
+            self.lines = []
+
+    def close(self):
+        if self.partial:
+            self.lines += [self.partial]
+            self.partial = ""
+        self.flush()
+
+class searchprocess:
+    """Watches a running ~/bin/searchgnucash (the fallback
+    when it cannot be imported) from background threads,
+    passing its output lines and -progressfd reports
+    back in self.results just as searchworker does."""
+    def __init__(self,proc,progressfd):
+        self.proc = proc
+        self.results = queue.Queue()
+        readers = [threading.Thread(target=self.readout,daemon=True),
+            threading.Thread(target=self.readerr,daemon=True),
+            threading.Thread(target=self.readprogress,\
+                args=(progressfd,),daemon=True)]
+        for t in readers:
+            t.start()
+        threading.Thread(target=self.waitfor,args=(readers,),\
+            daemon=True).start()
+
+    def readout(self):
+        lq = linequeue(self.results)
+        for l in self.proc.stdout:
+            lq.write(l)
+        lq.close()
+
+    def readerr(self):
+        global sclog
+        for l in self.proc.stderr:
+            print("search: stderr msg ",l.rstrip(),curtime(),\
+                flush=True,file=sclog)
+
+    def readprogress(self,fd):
+        with os.fdopen(fd,"r") as f:
+            for l in f:
+                try:
+                    self.results.put(("progress",json.loads(l)))
+                except ValueError:
+                    pass
+
+    def waitfor(self,readers):
+        for t in readers:
+            t.join()
+        if self.proc.wait() < 0:
+            self.results.put(("cancelled",None))
+        else:
+            self.results.put(("done",None))
+
+    def cancelsearch(self):
+        if self.proc.poll() == None:
+            self.proc.terminate()
+
+class searchworker:
+    """Loads the book and runs searches on one background
+    thread so the panel never waits on them.
+    Jobs go in self.jobs, and (kind,value) results come
+    back in self.results which the Tk thread polls.
+    kind is one of progress, lines, loaded, done,
+    cancelled, error.
+    """
+    def __init__(self,sg,bookpath):
+        self.sg = sg
+        self.bookpath = bookpath
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.cancel = threading.Event()
+        self.stamp = None
+        self.book = None
+        self.thread = threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+
+    def cancelsearch(self):
+        self.cancel.set()
+
+    def putprogress(self,d):
+        self.results.put(("progress",d))
+
+    def loadbook(self):
+        """Read the book unless the copy we have is current."""
+        sg = self.sg
+        stamp = sg.bookstamp(self.bookpath)
+        if stamp == self.stamp:
+            return
+        sg.setprogress(self.putprogress)
+        try:
+            self.book = sg.Book.open(self.bookpath)
+        finally:
+            sg.setprogress(None)
+        self.stamp = stamp
+
+    def search(self,args):
+        sg = self.sg
+        self.loadbook()
+        out = linequeue(self.results)
+        opts = sg.parseargs(args)
+        st = sg.makesearchterms(opts)
+        st.stermsprint(self.bookpath,out)
+        sg.setprogress(self.putprogress)
+        try:
+            found = list(self.book.matches(st,self.cancel.is_set))
+        finally:
+            sg.setprogress(None)
+        if self.cancel.is_set():
+            self.results.put(("cancelled",None))
+            return
+        self.putprogress({"phase":"report","matches":len(found)})
+        sg.printfound(found,st,out)
+        out.close()
+        self.results.put(("done",None))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            try:
+                if job[0] == "load":
+                    self.loadbook()
+                    self.results.put(("loaded",len(self.book.translist)))
+                elif job[0] == "search":
+                    self.cancel.clear()
+                    self.search(job[1])
+            except SystemExit:
+                # searchgnucash usage() rejected an option.
+                self.results.put(("error","Search options not accepted"))
+            except Exception as message:
+                self.results.put(("error",str(message)))
+
+# pdf page layout, in mm (A4 portrait).
+pdfleft = 10
+pdftop = 20
+pdfbottom = 282
+pdflineheight = 5
+pdffontsize = 10
+
+def pdfclean(s):
+    """The core pdf fonts are latin-1 only."""
+    return s.rstrip().encode("latin-1","replace").decode("latin-1")
+
+class pdfwriter:
+    """Renders report lines into a pdf on its own thread
+    as they arrive, so a big report neither waits for the
+    whole text nor blocks the panel.
+    Lines are placed at explicit positions with our own
+    page breaks, much cheaper than cell() with automatic
+    breaks, and each page gets a title and page number.
+    The thread is not a daemon so a Quit still lets the
+    pdf be finished.
+    """
+    def __init__(self,path,title):
+        self.path = path
+        self.title = title
+        self.lines = queue.Queue()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def add(self,textlines):
+        self.lines.put(textlines)
+
+    def finish(self):
+        self.lines.put(None)
+
+    def abandon(self):
+        self.lines.put(False)
+
+    def newpage(self,pdf):
+        pdf.add_page()
+        pdf.text(pdfleft,pdftop-8,pdfclean(self.title))
+        pdf.text(pdfleft,pdfbottom+8,"Page %d of {nb}"%(pdf.page_no()))
+        return pdftop
+
+    def run(self):
+        global sclog
+        pdf = FPDF()
+        pdf.alias_nb_pages()
+        pdf.set_auto_page_break(False)
+        # Make second arg "B" for bold. Want a fixed-width font.
+        pdf.set_font("Courier","B",size=pdffontsize)
+        y = self.newpage(pdf)
+        count = 0
+        while True:
+            textlines = self.lines.get()
+            if textlines is False:
+                return
+            if textlines is None:
+                break
+            for x in textlines:
+                if y > pdfbottom:
+                    y = self.newpage(pdf)
+                pdf.text(pdfleft,y,pdfclean(x))
+                y += pdflineheight
+            count += len(textlines)
+        try:
+            pdf.output(self.path)
+        except Exception as message:
+            print("search: cannot write",self.path,message,curtime(),\
+                flush=True,file=sclog)
+            return
+        print("search: wrote",count,"lines to",self.path,curtime(),\
+            flush=True,file=sclog)
+        self.done.set()
+
 def quotewrap(s):
     s2 = ''.join(['"',s,'"'])
     return sr2
@@ -192,6 +463,11 @@ class Application(ttk.Frame):
         # and "done" (only quit clickable)
         self.state = "starting"
         self.backupproc = False
+        self.searchproc = None
+        self.worker = None
+        self.workerstatus = ""
+        self.pdfw = None
+        self.pdflines = 0
         self.starttime = datetime.today()
 
         self.title = ttk.Label(self,style='TLabel')
@@ -366,11 +642,27 @@ class Application(ttk.Frame):
         self.srch = ttk.Button(self, text='Search',
             command=self.search,style='TButton')
         self.srch.grid(row=tkrow,column=2,padx=9,pady=9,sticky=tk.S)
+
+        self.cancel = ttk.Button(self, text='Cancel',
+            command=self.cancelsearch,style='TButton')
+        self.cancel.grid(row=tkrow,column=3,padx=9,pady=9,sticky=tk.S)
         tkrow += 1
         self.quit.state(["!disabled"]) 
         self.srch.state(["!disabled"]) 
+        self.cancel.state(["disabled"]) 
         self.status = ttk.Label(self,text= "     ",style='TLabel')
         self.status.grid(row=tkrow,columnspan=cspan)
+        self.startworker()
+
+    def startworker(self):
+        """Start reading the book now so the first search
+        does not wait for it."""
+        sg = loadsearchengine()
+        if not sg or not path:
+            return
+        self.worker = searchworker(sg,path)
+        self.worker.jobs.put(("load",))
+        self.after(pollwaittime,self.watchworker)
       
     def acctrep(self):
         if self.casearvar == 0:
@@ -499,105 +791,153 @@ class Application(ttk.Frame):
         self.state = "running"
         print("search: starts now ",cmd3,"  at ",curtime(),\
             flush=True,file=sclog)
+        self.startpdf()
+        if self.worker:
+            self.worker.jobs.put(("search",cmd3[1:]))
+            self.quit.state(["disabled"]) 
+            self.srch.state(["disabled"]) 
+            self.cancel.state(["!disabled"]) 
+            return
+        # searchgnucash reports progress on this pipe.
+        (progressr,progressw) = os.pipe()
+        cmd3 += ["-progressfd",str(progressw)]
+        expandedcmd += " -progressfd %d"%(progressw)
         try:
             if macos:
                 self.backupproc = subprocess.Popen(expandedcmd,\
                     stdout=subprocess.PIPE, stderr=subprocess.PIPE,\
-                    universal_newlines = True,shell=True)
+                    universal_newlines = True,shell=True,\
+                    pass_fds=(progressw,))
             else:
                 self.backupproc = subprocess.Popen(cmd3,\
                     stdout=subprocess.PIPE, stderr=subprocess.PIPE,\
-                    universal_newlines = True)
+                    universal_newlines = True,pass_fds=(progressw,))
         except subprocess.TimeoutExpired as message:
             print("TimeoutExpired at Popen ,maybe dead: ",\
                 quotewrap(expandedcmd),message,curtime(),\
                 flush=True,file=sclog)
+            self.abandonpdf()
             sys.exit(1)
         except subprocess.CalledProcessError as message:
             print("CalledProcesserror at Popen ,maybe dead: ",\
                 quotewrap(expandedcmd),message,curtime(),\
                 flush=True,file=sclog)
+            self.abandonpdf()
             sys.exit(1)
         except:
             print("Error in subprocess at Popen ,maybe dead: ",\
                 quotewrap(expandedcmd),curtime(),flush=True,file=sclog)
+            self.abandonpdf()
             sys.exit(1)
+        os.close(progressw)
+        self.searchproc = searchprocess(self.backupproc,progressr)
   
         self.quit.state(["disabled"]) 
         self.srch.state(["disabled"]) 
-        self.after(afterwaittime,self.watchsearch)
+        self.cancel.state(["!disabled"]) 
+        self.after(pollwaittime,self.watchworker)
         return
 
-    def secondsonly(self,mins,minstr):
-      sofar = "Run time so far: %s minutes"%(minstr)
-      if int(mins) == 1:
-        sofar = "Run time so far: %s minute"%(minstr)
-      return sofar
-
-    def minutesonly(self,mins,minstr):
-        sofar = "Run time so far: %s minutes"%(minstr)
-        if int(mins) == 1:
-            sofar = "Run time so far: %s minute"%(minstr)
-        return sofar
-
-    def writetopdf(self,textlines):
-        path = os.path.join(ghome,"Desktop",curtimefile())
-        pdf = FPDF()    
-        pdf.add_page() 
-        # Make second arg "B" for bold. Want a fixed-width font.
-        pdf.set_font("Courier","B", size = 12) 
-        for x in textlines: 
-            pdf.cell(100,8, txt = x.rstrip(), ln = 1, align = 'L') 
-        pdf.output(path)
-
-    def watchsearch(self):
-        global targetdir
-        nowtime = datetime.today()
-        kbval = 0.0
-        dt = nowtime - self.starttime
-        secs = dt.total_seconds()
-        mins = int(secs+30)/60
-        minstr = str(int(mins))
-        secstr = str(int(secs))
-        m= "Searchtime so far: %d seconds"%(int(secs))
-        self.status.configure(text=m)
-        if  not self.backupproc:
-            # serious error
-            print("backup: impossible error, no backupproc", \
-                curtime(),flush=True,file=sclog)
-            sys.exit(1)
-        if  self.backupproc.poll() == None:
-            global watchloopcount
-            # loop again,
-            if (watchloopcount%10) == 0:
-                print("backup: watchsearch loop ",\
-                    watchloopcount,".",\
-                    curtime(),flush=True,file=sclog)
-            self.after(afterwaittime,self.watchsearch)
-            watchloopcount = int(watchloopcount) +1
-            return
-        (s2,errors) = self.backupproc.communicate()
-        if errors != '':
-            # serious error?
-            print("backup: tar messages on stderr? ", \
-                curtime(),flush=True,file=sclog)
-            print("backup: stderr msgs ", \
-                errors,curtime(),flush=True,file=sclog)
-        slines = s2.split("\n")
-        self.writetopdf(slines)
+    def searchfinished(self,m):
         self.state = "Ready to Search"
-  
-        m="Ready for another Search"
         self.status.configure(text=m)
         self.blanklabel2.configure(text="Ready for another search")
         self.quit.state(["!disabled"]) 
         self.srch.state(["!disabled"]) 
-  
+        self.cancel.state(["disabled"]) 
+
+    def cancelsearch(self):
+        print("search: cancel requested",curtime(),flush=True,file=sclog)
+        if self.worker:
+            self.worker.cancelsearch()
+        elif self.searchproc:
+            self.searchproc.cancelsearch()
+
+    def watchworker(self):
+        """Runs every pollwaittime ms taking results from
+        the search thread or process."""
+        if self.worker:
+            self.takeresults(self.worker.results)
+        elif self.searchproc:
+            self.takeresults(self.searchproc.results)
+        if self.state == "running":
+            secs = (datetime.today() - self.starttime).total_seconds()
+            m= "Searchtime so far: %d seconds %s"%(int(secs),\
+                self.workerstatus)
+            if self.pdflines > 0:
+                m += ", %d report lines"%(self.pdflines)
+            self.status.configure(text=m)
+        if self.worker or self.state == "running":
+            self.after(pollwaittime,self.watchworker)
+
+    def takeresults(self,results):
+        while True:
+            try:
+                kind,value = results.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "progress":
+                self.workerstatus = progresstext(value)
+            elif kind == "lines":
+                self.addpdflines(value)
+            elif kind == "loaded":
+                print("search: book loaded,",value,"transactions",\
+                    curtime(),flush=True,file=sclog)
+                self.workerstatus = ""
+                if self.state != "running":
+                    self.status.configure(text="Book loaded")
+            elif kind == "done":
+                self.workerstatus = ""
+                self.finishpdf()
+                self.searchfinished("Ready for another Search")
+            elif kind == "cancelled":
+                self.workerstatus = ""
+                self.abandonpdf()
+                self.searchfinished("Search cancelled")
+            elif kind == "error":
+                print("search: error",value,curtime(),\
+                    flush=True,file=sclog)
+                self.workerstatus = ""
+                self.abandonpdf()
+                self.searchfinished("Search failed: %s"%(value))
+
+    # The report goes to the pdfwriter thread line by line
+    # as it arrives, rather than all at once at the end.
+    def startpdf(self):
+        path = os.path.join(ghome,"Desktop",curtimefile())
+        ti = "%s: Search GnuCash %s"%(hostname,curtime())
+        self.pdfw = pdfwriter(path,ti)
+        self.pdflines = 0
+
+    def addpdflines(self,textlines):
+        if not self.pdfw:
+            return
+        self.pdfw.add(textlines)
+        self.pdflines += len(textlines)
+
+    def finishpdf(self):
+        if not self.pdfw:
+            return
+        self.pdfw.finish()
+        self.pdfw = None
+
+    def abandonpdf(self):
+        if not self.pdfw:
+            return
+        self.pdfw.abandon()
+        self.pdfw = None
+
     def waitonquit(self):
         self.after(afterwaittime,self.waitonquit)
         return
 
     def cleanupdestroy(self):
+        """Quit, or the window closed. A search still running
+        is stopped and its pdf abandoned, else the pdfwriter
+        thread would wait for lines forever."""
+        if self.state == "running":
+            self.cancelsearch()
+            self.abandonpdf()
         root.destroy()
 
 i = 1
@@ -613,4 +953,5 @@ root.title("Search Gnu Cash")
 root.geometry(mygeom)
 q3host="q3"
 app = Application(master=root)                   
+root.protocol("WM_DELETE_WINDOW",app.cleanupdestroy)
 app.mainloop()                      
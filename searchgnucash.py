@@ -66,8 +66,27 @@
 import sys 
 import os
 import gzip
+import bisect
+import pickle
+import hashlib
+import glob
+import json
+import re
+import sqlite3
+import csv
+import io
+import mmap
+import shlex
+import http.server
+import collections
+import concurrent.futures
+import itertools
+from array import array
+from decimal import Decimal, InvalidOperation
 from datetime import datetime, date, time
+from time import sleep, monotonic
 import xml.etree.ElementTree as ET
+import xml.parsers.expat
 
 
 def usage(msg):
@@ -75,6 +94,7 @@ def usage(msg):
     print(msg)
     print("Usage: [-case {1,0}]")
     print("       [-s srchterm]* ")
+    print("       [-amount value] [-amount-range low..high] [-abs]")
     print("       [-d dateselected]") 
     print("       [-allafter date]")
     print("       [-datetype [both|posted|entered]]")
@@ -82,15 +102,45 @@ def usage(msg):
     print("       [-accountreport] [-accountselect acctname] ")
     print("       [-printacctnames] ")
     print("       [-csv] ")
-    print("       [-f cashpath]")
+    print("       [-cache [-cacheshards year|month]] [-index]")
+    print("       [-resultcache [-resultcachesize megabytes]]")
+    print("       [-diff cashpatha cashpathb]")
+    print("       [-history]")
+    print("       [-validate]")
+    print("       [-watch] [-watchinterval seconds]")
+    print("       [-queries queryfile]")
+    print("       [-progressfd fd]")
+    print("       [-format text|jsonl|csv]")
+    print("       [-balances date]")
+    print("       [-parser etree|expat]")
+    print("       [-reconcile statement.csv [-reconcilewindow days]]")
+    print("       [-sumto amount [-sumtosize n] [-sumtotime seconds]]")
+    print("       [-duplicates [-duplicatewindow days]]")
+    print("       [-fuzzy [-fuzzydistance n] [-fuzzydays n]]")
+    print("       [-http host:port [-httpcache n]]")
+    print("       [-f cashpath ...]")
     print("       [-h] ")
  
     print("Any dates here must be in the form YYYY-MM-DD or")
     print("  any initial subrange of that ('2021-11' for example).")  
     print("Where -h prints this usage and exits.")
+    print("Where -f names the book: XML (gzip'd or not) or a")
+    print("  GnuCash sqlite book, which is searched with SQL")
+    print("  so only likely matches are read.")
+    print("  Several paths or patterns like 'books/*.gnucash' search")
+    print("  all those books at once, each reported separately, then")
+    print("  the totals of all of them.")
     print("Where -s terms (any number of -s arguments allowed)")
     print("  are 'and' terms so all must match to select transaction")
     print("  to print.")
+    print("Where -amount selects transactions with a split of exactly")
+    print("  that value ('-amount 255.41'). Unlike '-s 255.41' this")
+    print("  does not also match 1255.41 or 255.410.")
+    print("Where -amount-range selects transactions with a split value")
+    print("  in low..high inclusive ('-amount-range 100..250').")
+    print("  Either end may be omitted ('100..' or '..250').")
+    print("Where -abs makes -amount and -amount-range compare the")
+    print("  absolute value of splits, so debits and credits both match.")
     print("Where -d dateselected is ISO extended-date form:")
     print("  '-d 2014'         matches 2014")
     print("  '-d 2013-02'      matches any February 2013 date")
@@ -109,9 +159,97 @@ def usage(msg):
     print("  useful for year-end reporting.")
     print("Where -accountselect allows specifying an account name.")
     print("  Only transactions using that name will be printed.")
+    print("  With -accountreport a last column shows the true")
+    print("  balance of that account after each split.")
     print("Where -csv means splits are  a three column csv format")
     print("Where -printacctnames produces a list of account")
     print("   names so you can get the precise spelling(s).")
+    print("Where -diff compares two GnuCash files transaction by")
+    print("   transaction (matched by guid) and reports those added,")
+    print("   removed or changed, field by field. The other options")
+    print("   restrict which differences are reported.")
+    print("Where -validate checks the whole book for fields with")
+    print("   control or non-ascii characters, transactions whose")
+    print("   splits do not sum to zero, splits or accounts naming")
+    print("   a missing account, and duplicate guids.")
+    print("   The exit status is 1 if anything was found.")
+    print("Where -history searches every GnuCash backup of the book")
+    print("   (cashpath.YYYYMMDDHHMMSS.gnucash) and the book itself")
+    print("   and shows, per matching transaction, the versions in")
+    print("   which it appeared, changed, or went away.")
+    print("Where -watch prints the usual report and then waits,")
+    print("   checking the book every -watchinterval seconds")
+    print("   (default 2). Each time GnuCash saves the book only")
+    print("   transactions new or changed by that save are searched")
+    print("   and any that match are printed. Control-C to stop.")
+    print("Where -queries names a file with one set of search options")
+    print("   per line (as on the command line, '#' lines ignored).")
+    print("   The book is read once and searched for every line.")
+    print("   A line may add '-o outpath' to write its report to")
+    print("   outpath, otherwise reports go to stdout one after")
+    print("   another, each headed by its query line.")
+    print("   With -watch every line is watched.")
+    print("Where -progressfd names an open file descriptor on which")
+    print("   progress is written as JSON lines, a few per second,")
+    print("   with the phase and counts of bytes decompressed,")
+    print("   transactions scanned and matches so far.")
+    print("Where -format jsonl writes one JSON object per matching")
+    print("   transaction, with its splits, and -format csv writes")
+    print("   one csv row per split. Both have guids, ISO dates,")
+    print("   amounts as integer cents, and full account names,")
+    print("   and no report heading. The default is -format text.")
+    print("   -format applies to searches and -queries only.")
+    print("Where -balances prints the balance of every account, and")
+    print("   of each account with its subaccounts, as of the end of")
+    print("   the (full or partial) posted date. With -accountselect")
+    print("   only that account and its subaccounts are shown.")
+    print("Where -reconcile pairs the rows of a bank or card statement")
+    print("   (csv, with a header line naming date and amount columns)")
+    print("   with the splits of the -accountselect account of the same")
+    print("   amount posted within -reconcilewindow days (default 3),")
+    print("   and lists what is only on the statement or only in the book.")
+    print("Where -sumto finds combinations of up to -sumtosize splits")
+    print("   (default 4) adding up to the amount, from the splits of")
+    print("   the -accountselect account in the transactions found, or")
+    print("   else the splits matching the search. It gives up after")
+    print("   -sumtotime seconds (default 10).")
+    print("Where -duplicates lists groups of transactions with the same")
+    print("   description (ignoring case and punctuation) and amounts")
+    print("   in the same accounts, posted on the same day or within")
+    print("   -duplicatewindow days, as double imports would be.")
+    print("Where -fuzzy lets -s terms match description and memo words")
+    print("   with typos (one edit in words up to five letters, two in")
+    print("   longer ones, or -fuzzydistance edits), a -d date be off")
+    print("   by two swapped digits or -fuzzydays days (default 3),")
+    print("   and an -amount be one digit off. The closest come first.")
+    print("Where -http host:port (like 127.0.0.1:8080) keeps the book")
+    print("   loaded, reading it again when it changes, and answers")
+    print("   POST /search with a JSON object of options, like")
+    print("   {\"s\": [\"Costco\"], \"d\": \"2022\", \"amount-range\": \"10..20\"},")
+    print("   with the -format jsonl records. The fields are s, d,")
+    print("   accountselect, amount, amount-range, abs, case and")
+    print("   datetype. The last -httpcache (default 100) answers are")
+    print("   kept for repeated requests. GET /status shows the book")
+    print("   and cache counts.")
+    print("Where -parser expat reads the book with a small expat")
+    print("   state machine instead of building an element tree,")
+    print("   which is faster and uses much less memory.")
+    print("Where -cache keeps a copy of the parsed book next to the")
+    print("   book (cashpath.sgcache) so later runs skip the gzip and")
+    print("   xml work. It is rebuilt whenever the book changes.")
+    print("   The cache is split by posted year (or month, with")
+    print("   -cacheshards month) so a search by date reads only the")
+    print("   years (months) it could match, and each year (month)")
+    print("   in blocks that are skipped when they cannot hold every")
+    print("   -s term of three or more characters.")
+    print("Where -resultcache keeps the report of each search in")
+    print("   ~/.cache/searchgnucash, so the same search of the same")
+    print("   (unchanged) book prints it again without reading the book.")
+    print("   The least recently used reports are removed when they")
+    print("   pass -resultcachesize megabytes (default 50).")
+    print("Where -index (implies -cache) also keeps a trigram index")
+    print("   (cashpath.sgtri) so -s terms of three or more characters")
+    print("   only look at transactions that could contain them.")
     sys.exit(1)
 
 
@@ -175,6 +313,7 @@ class transaction_entry:
         self._dateentered = dateentered
         self._transactionnum = transnum
         self._description = descr
+        self._foundmatch = False
         self._tguid = tguid
 
     def add_tdata(self, dateposted, dateentered, transnum, descr, tguid):
@@ -187,7 +326,7 @@ class transaction_entry:
     def markmatch(self):
         self._foundmatch = True
 
-    def tprint(self, st):
+    def tprint(self, st, out=None):
         # print("dadebug","posted",self._dateposted,"entered",self._dateentered)
         # print("            %6s"%self._transactionnum,":",self._description)
         ew = self._dateposted.strip().split()
@@ -195,7 +334,7 @@ class transaction_entry:
             ews = ew[0]
         else:
             ews = "no-date"
-        print("")
+        print("", file=out)
         ee = self._dateentered.strip().split()
         print(
             "Trans: p:%s e:%s %-6s %s"
@@ -203,16 +342,18 @@ class transaction_entry:
                 ews,
                 ee[0],
                 slimdescr(self._transactionnum.strip(), 6),
-                self._description.strip())
-            )
+                self._description.strip()),
+            file=out)
         b, nl = badfield(self._transactionnum)
         if b:
-            print("  Badfield", nl, " transactionnum", self._transactionnum)
-            print("  tguid   ", self._tguid)
+            print("  Badfield", nl, " transactionnum", self._transactionnum,
+                file=out)
+            print("  tguid   ", self._tguid, file=out)
         b, nl = badfield(self._description)
         if b:
-            print("  Badfield", nl, " description ", self._description)
-            print("  tguid   ", self._tguid)
+            print("  Badfield", nl, " description ", self._description,
+                file=out)
+            print("  tguid   ", self._tguid, file=out)
 
     def __lt__(self, other):
         if self._dateposted == other._dateposted:
@@ -229,21 +370,31 @@ class split_entry:
         self._accttype = ""
         self._foundmatch = False
         self._sguid = ""
+        self._cents = 0
+        self._acctguid = ""
+        self._acctpath = ""
 
     def markmatch(self):
         #print("dadebug markmatch on",self._memo)
         self._foundmatch = True
 
     # Value is a string of a float created by stdval()
-    def add_splitdata(self, memo, tnum, value, acctname, accttype, sguid):
+    # cents is the same value as an int number of pennies,
+    # see valcents().
+    # acctpath is the full account name, see acctfullname().
+    def add_splitdata(self, memo, tnum, value, acctname, accttype, sguid,
+        cents, acctguid, acctpath):
         self._memo = memo
         self._value = value
+        self._cents = cents
+        self._acctguid = acctguid
+        self._acctpath = acctpath
         self._chknum = tnum
         self._acctname = acctname
         self._accttype = accttype
         self._guid = sguid
 
-    def sprint(self, msg, acctsumdict,st):
+    def sprint(self, msg, acctsumdict, st, out=None):
         acctname = self._acctname.strip()
         val = float(self._value)
         ov = acctsumdict.get(acctname, 0)
@@ -253,7 +404,7 @@ class split_entry:
         if st._csvformat:
             f= '\"%s %24s\",%9.2f,\"%s\"'% \
                 (chknum,memo,val,acctname)
-            print(f)
+            print(f, file=out)
         elif len(memo) < 26:
             print( msg,
                 " %-4s %-26s %9.2f %-22s"
@@ -262,24 +413,24 @@ class split_entry:
                     memo,
                     val,
                     acctname,
-               ))
+               ), file=out)
         else:
             print( msg,
                 " %-4s %s " %(
                 slimdescr(chknum,4),
-                memo))
+                memo), file=out)
             print( msg, 
                 "%33s %8.2f %s"%('',
                     val, 
-                    acctname))
+                    acctname), file=out)
         b, nl = badfield(self._memo)
         if b:
-            print("   Badfield", nl, " memo ", self._memo)
-            print("   sguid  ", self._guid)
+            print("   Badfield", nl, " memo ", self._memo, file=out)
+            print("   sguid  ", self._guid, file=out)
         b, nl = badfield(self._chknum)
         if b:
-            print("   Badfield", nl, " chknum ", self._chknum)
-            print("   sguid  ", self._guid)
+            print("   Badfield", nl, " chknum ", self._chknum, file=out)
+            print("   sguid  ", self._guid, file=out)
 
 def dictaddfloat(dct,key,val):
     v1 = dct.get(key,0.0)
@@ -296,6 +447,15 @@ class whole_transaction:
     def markmatch(self):
         self._foundmatch = True
 
+    def clearmatch(self):
+        """Forget the marks of any earlier search, so
+        the same transaction can be searched again."""
+        self._foundmatch = False
+        self._printallsplits = True
+        self._trans._foundmatch = False
+        for s in self._splits:
+            s._foundmatch = False
+
     def add_transentry(self, transentry):
         self._trans = transentry
         self._splits = []
@@ -311,7 +471,7 @@ class whole_transaction:
         return splitmarklist
 
 
-    def wprint(self, title, st, acctsumdict):
+    def wprint(self, title, st, acctsumdict, out=None):
         #print("dadebug wprint entered. ")
         if st._accountreport:
             posted= self._trans._dateposted.strip().split()
@@ -331,7 +491,7 @@ class whole_transaction:
                        tot = 0.0
                     print("===========Posted Month %s Sum %9.2f"% \
                         (lastmonthonlyname, \
-                        float(tot)))
+                        float(tot)), file=out)
                     lastmonthonlyname = monthonly
                     acctsumdict["lastmonth"] = monthonly
                 else:
@@ -346,7 +506,7 @@ class whole_transaction:
                         tot = 0.0
                     print("===========Posted Year %s Sum %9.2f"%\
                         (lastyearonlyname, \
-                        float(tot)))
+                        float(tot)), file=out)
                     lastyearonlyname = yearonly
                     acctsumdict["lastyear"] = yearonly
                 else:
@@ -368,28 +528,34 @@ class whole_transaction:
                 f1  = float(s._value.strip())
                 f2  = float(acctsumdict.get(act))
                 memo = s._memo.strip()
+                # The true account balance after this split.
+                bal = ""
+                if st._balanceindex:
+                    b = st._balanceindex.runningbalance(self._trans, s)
+                    bal = " %10.2f" % (b / 100.0)
 
                 if len(descr) > 20  or len(memo) > 20 or len(act) > 10:
-                    print("p:%s e:%s "%(dayonly,edayonly),end='')
-                    print("    %-s"%(descr))
+                    print("p:%s e:%s "%(dayonly,edayonly),end='', file=out)
+                    print("    %-s"%(descr), file=out)
                     if len(memo) <= 20:
                         # two lines
-                        print("    %-15s memo:%-20s"%(act[0:15],memo),end='') 
-                        print("%37s  %9.2f %9.2f"% ("",f1,f2))
+                        print("    %-15s memo:%-20s"%(act[0:15],memo),end='',
+                            file=out)
+                        print("%37s  %9.2f %9.2f%s"% ("",f1,f2,bal), file=out)
                     else:
                         # three lines
-                        print("    %-15s memo: %s"%(act,memo)) 
-                        print("%82s  %9.2f %9.2f"% ("",f1,f2))
+                        print("    %-15s memo: %s"%(act,memo), file=out) 
+                        print("%82s  %9.2f %9.2f%s"% ("",f1,f2,bal), file=out)
                 else:
-                    print("dadebug all one line")
-                    print("p:%s e:%s "%(dayonly,edayonly),end='')
-                    print("%-20s %-15s %-20s %9.2f %9.2f"% \
+                    print("dadebug all one line", file=out)
+                    print("p:%s e:%s "%(dayonly,edayonly),end='', file=out)
+                    print("%-20s %-15s %-20s %9.2f %9.2f%s"% \
                         (descr[0:20],\
                         act[0:15], \
                         memo[0:20], \
-                        f1, f2 ))
+                        f1, f2, bal ), file=out)
             return
-        self._trans.tprint(st)
+        self._trans.tprint(st, out)
         if st._onlytranslines:
             #print("dadebug onlytrans")
             return
@@ -406,12 +572,58 @@ class whole_transaction:
         for s in self._splits:
             #print("dadebug split ",s._memo,s._foundmatch)
             if s._foundmatch or self._printallsplits:
-                s.sprint("", acctsumdict,st)
+                s.sprint("", acctsumdict, st, out)
 
     def __lt__(self, other):
         return self._trans < other._trans
 
 
+# Progress reporting. progressfn, if set, is called with
+# a dict holding "phase" and whatever counts apply, at
+# most every progressinterval seconds unless forced,
+# and never twice in a row with the same dict.
+progressfn = None
+progresslast = 0.0
+progresssent = None
+progressinterval = 0.25
+
+
+def setprogress(fn):
+    global progressfn, progresssent
+    progressfn = fn
+    progresssent = None
+
+
+def progress(d, force):
+    global progresslast, progresssent
+    if not progressfn:
+        return
+    if d == progresssent:
+        return
+    now = monotonic()
+    if not force and now - progresslast < progressinterval:
+        return
+    progresslast = now
+    progresssent = d
+    progressfn(d)
+
+
+def progresstofd(fd):
+    """Send progress as JSON lines to the open fd."""
+    try:
+        f = os.fdopen(fd, "w", buffering=1)
+    except OSError as e:
+        usage("-progressfd %d is not usable: %s" % (fd, e))
+
+    def writeprogress(d):
+        try:
+            f.write(json.dumps(d) + "\n")
+        except OSError:
+            # Reader went away, stop reporting.
+            setprogress(None)
+    setprogress(writeprogress)
+
+
 def curtime():
     dt = datetime.now()
     tm = dt.strftime("%Y-%m-%d %H:%M:%S")
@@ -435,7 +647,11 @@ class searchterms:
         accountselect,
         printacctnames,
         accountreport,
-        datetype,csvformat
+        datetype,csvformat,
+        amountlow,
+        amounthigh,
+        amountabs,
+        outformat
     ):
         self._casesense = casesense
         self._dateselected = dateselected
@@ -449,6 +665,16 @@ class searchterms:
         self._accountreport = accountreport
         self._datetype = datetype
         self._csvformat = csvformat
+        # Integer cents, False means no limit on that end.
+        # Both False means no amount selection at all.
+        self._amountlow = amountlow
+        self._amounthigh = amounthigh
+        self._amountabs = amountabs
+        # "text", "jsonl" or "csv"
+        self._outformat = outformat
+        # A balance_index when -accountreport wants the
+        # true running balance of the -accountselect account.
+        self._balanceindex = None
         # this is a bit like passing incompletely
         # constructed record...
         # Even though all our fields are set to something.
@@ -523,62 +749,129 @@ class searchterms:
             return self.afterdate(l,donly,b)
         return True
 
-    def stermsprint(self,fname):
-        print(    "Search Date   :", curtime())
-        print(    "Search In     :", fname)
+    def datebounds(self, postedlo, postedhi, enteredlo, enteredhi):
+        """False if no transaction posted and entered within
+        these (inclusive) date bounds could pass dateinrange()."""
+        if self._datetype:
+            if self._datetype == "posted":
+                return self.dateboundsb(postedlo, postedhi)
+            else:
+                return self.dateboundsb(enteredlo, enteredhi)
+        if self.dateboundsb(postedlo, postedhi):
+            return True
+        if self.dateboundsb(enteredlo, enteredhi):
+            return True
+        return False
+
+    def dateboundsb(self, lo, hi):
+        if self._dateselected:
+            b = self._dateselected
+            l = len(b)
+            return lo[0:l] <= b <= hi[0:l]
+        if self._printallafter:
+            # afterdate() is the first l characters at or
+            # after b.
+            b = self._printallafter
+            l = len(b)
+            return hi[0:l] >= b
+        return True
+
+    def amountselected(self):
+        if self._amountlow is False and self._amounthigh is False:
+            return False
+        return True
+
+    def wantsbalances(self):
+        """True when the report has the running balance
+        column, an -accountreport of an -accountselect."""
+        if self._accountreport and self._accountselect:
+            return True
+        return False
+
+    def amountinrange(self,cents):
+        if self._amountabs:
+            cents = abs(cents)
+        if self._amountlow is not False and cents < self._amountlow:
+            return False
+        if self._amounthigh is not False and cents > self._amounthigh:
+            return False
+        return True
+
+    def stermsprint(self, fname, out=None):
+        if self._outformat != "text":
+            # Machine formats have no heading.
+            return
+        print(    "Search Date   :", curtime(), file=out)
+        print(    "Search In     :", fname, file=out)
         if len(self._printchecklist) > 0:
             print(    "Searchterms   :", \
-                str(len(self._printchecklist)))
+                str(len(self._printchecklist)), file=out)
             for i in self._printchecklist:
                 s = quoteme(i)
                 print( \
-                  "SearchFor     :", s)
+                  "SearchFor     :", s, file=out)
         else:
-            print("Searchterms   : none")
+            print("Searchterms   : none", file=out)
 
         cs = "Casesensitive : %s" % yesno(self._casesense)
-        print(cs)
+        print(cs, file=out)
 
           
         content = "posted and entered checked"
         if self._datetype:
             content = self._datetype
         d =   "Date Type     : %s" % content
-        print(d)
+        print(d, file=out)
 
         content = ""
         if self._dateselected:
             content =   self._dateselected
         d =   "Date Selected : %s" % content
-        print(d)
+        print(d, file=out)
 
 
         content = ""
         if self._printallafter:
             content = self._printallafter
         alla= "AllAfterDate  : %s" % content
-        print(alla)
+        print(alla, file=out)
         
         content = "no" 
         if self._onlytranslines:
              content = "yes"
         d =   "Trans. Only   : %s" % content
-        print(d)
+        print(d, file=out)
 
         content = "no"
         if self._accountreport:
             content = "yes"
         d =   "Account Report: %s" % content
-        print(d)
+        print(d, file=out)
 
         content = ""
         if self._accountselect:
             content=str(self._accountselect)
-        print("Report Account:", content)
+        print("Report Account:", content, file=out)
+
+        content = ""
+        if self.amountselected():
+            lo = ""
+            hi = ""
+            if self._amountlow is not False:
+                lo = centsstr(self._amountlow)
+            if self._amounthigh is not False:
+                hi = centsstr(self._amounthigh)
+            if lo == hi:
+                content = lo
+            else:
+                content = "%s..%s" % (lo, hi)
+            if self._amountabs:
+                content += " (absolute value)"
+        print("Amount Select :", content, file=out)
 
-        print("We truncate the description and memo fields in")
-        print("the output,so the matching part of a transaction")
-        print("or split might not show in this report.")
+        print("We truncate the description and memo fields in", file=out)
+        print("the output,so the matching part of a transaction", file=out)
+        print("or split might not show in this report.", file=out)
 
 
 def yesno(yn):
@@ -662,6 +955,74 @@ def searchmatchsplit(s, st):
     return matchedck, False, acctterm
 
 
+def searchmatchamount(wholetrans, st):
+    """Mark the splits whose value is in the -amount
+    range. With -accountselect only splits of that account count.
+    Return True if any split is in range.
+    """
+    found = False
+    us = False
+    if st._accountselect:
+        us = actic(st._accountselect, st)
+    for s in wholetrans._splits:
+        if not st.amountinrange(s._cents):
+            continue
+        if us and actic(s._acctname, st) != us:
+            continue
+        s.markmatch()
+        found = True
+    return found
+
+
+class amount_index:
+    """Split values (integer cents) sorted, each with the
+    position in translist of its transaction.
+    A lookup is a bisect on the sorted values, so
+    finding an amount is O(log n + hits) rather than
+    a scan of every split in the book.
+    """
+    def __init__(self, translist):
+        pairs = []
+        for (i, w) in enumerate(translist):
+            for s in w._splits:
+                pairs += [(s._cents, i)]
+        pairs.sort()
+        self._cents = [p[0] for p in pairs]
+        self._transnum = [p[1] for p in pairs]
+
+    def lookuprange(self, low, high, found):
+        if low is False:
+            lo = 0
+        else:
+            lo = bisect.bisect_left(self._cents, low)
+        if high is False:
+            hi = len(self._cents)
+        else:
+            hi = bisect.bisect_right(self._cents, high)
+        for k in range(lo, hi):
+            found[self._transnum[k]] = 1
+
+    def lookup(self, st):
+        """Return the sorted translist positions of
+        transactions with a split in the st amount range."""
+        found = {}
+        low = st._amountlow
+        high = st._amounthigh
+        if not st._amountabs:
+            self.lookuprange(low, high, found)
+            return sorted(found.keys())
+        # With -abs look on both sides of zero.
+        # A missing or negative low end means zero for abs values.
+        if low is False or low < 0:
+            low = 0
+        self.lookuprange(low, high, found)
+        nlow = False
+        if high is not False:
+            nlow = -high
+        self.lookuprange(nlow, -low, found)
+        return sorted(found.keys())
+
+
 def searchmatches(wholetrans, st):
     """See if the trans matches. Return "y" if so, else return "n" """
     transcheck = wholetrans._trans
@@ -674,6 +1035,9 @@ def searchmatches(wholetrans, st):
     if len(foundlist) == 1 and foundlist[0] == "date":
         # Wrong date, not a transaction we want to show.
         return "n"
+    if st.amountselected():
+        if not searchmatchamount(wholetrans, st):
+            return "n"
     for e in foundlist:
         founddict[e] = 1
     if len(foundlist) > 0:
@@ -737,14 +1101,14 @@ def searchmatches(wholetrans, st):
     return "y"
 
 
-def printtransmatch(wholetrans, st, acctsumdict):
+def printtransmatch(wholetrans, st, acctsumdict, out=None):
     """Print a report for the matching transaction."""
     # On overall match (meaning we were called):
     # Print the base transaction record.
     # If several splits had a partial match, print those.
     # If no splits contributed, print all the splits.
     #   (or should we just print one as a token?)
-    wholetrans.wprint("Match:", st, acctsumdict)
+    wholetrans.wprint("Match:", st, acctsumdict, out)
 
 
 def shorttag(orig):
@@ -794,6 +1158,39 @@ def stdval(val):
         return val
 
 
+def valcents(val):
+    """Turn the x/y value into an int number of cents.
+    Unlike stdval() this works for any denominator
+    and keeps the sign, so it is the value used for
+    amount comparisons and arithmetic.
+    """
+    if not val:
+        return 0
+    wds = val.split("/")
+    num = int(wds[0])
+    if len(wds) < 2:
+        return num * 100
+    den = int(wds[1])
+    if den == 100:
+        return num
+    # Round half away from zero, as a person would.
+    q, r = divmod(abs(num) * 100, den)
+    if 2 * r >= den:
+        q += 1
+    if num < 0:
+        return -q
+    return q
+
+
+def centsstr(cents):
+    """An int number of cents as text like 255.41 or -0.05"""
+    sign = ""
+    if cents < 0:
+        sign = "-"
+    c = abs(int(cents))
+    return "%s%d.%02d" % (sign, c // 100, c % 100)
+
+
 def datewithouttz(d):
     """we strip off the trailing tz info, no need for that"""
     wds = d.split()
@@ -835,7 +1232,9 @@ def print_account_names(acctdict):
     sys.exit(0)
 
 
-def gettransdata(elem, acctdict, splitdict, transdict, st):
+def buildtrans(elem, acctdict):
+    """Turn one transaction element into a whole_transaction,
+    with no searching done."""
     transposteddate = ""
     transenteredate = ""
     transguid = ""
@@ -859,9 +1258,10 @@ def gettransdata(elem, acctdict, splitdict, transdict, st):
                     transentereddate = datewithouttz(child2.text)
                     break
         elif ctag == "num":
-            transnum = child.text
+            # Empty elements have None text.
+            transnum = child.text or ""
         elif ctag == "description":
-            transdescr = child.text
+            transdescr = child.text or ""
         elif ctag == "id":
             isguid = child.get("type")
             if isguid == "guid":
@@ -893,6 +1293,7 @@ def gettransdata(elem, acctdict, splitdict, transdict, st):
             for child2 in child:
                 sguid = ""
                 svalue = ""
+                scents = 0
                 smemo = ""
                 sacctguid = ""
                 acctname = ""
@@ -910,13 +1311,14 @@ def gettransdata(elem, acctdict, splitdict, transdict, st):
                         elif c3tag == "action":
                             # This is the 'check number' field in trans entries
                             # Why was this calling stdval() before 01/2021?
-                            tnum = child3.text
+                            tnum = child3.text or ""
                         elif c3tag == "value":
                             svalue = stdval(child3.text)
+                            scents = valcents(child3.text)
                         # elif c3tag =="num":
                         #  tnum = stdval(child3.text)
                         elif c3tag == "memo":
-                            smemo = child3.text
+                            smemo = child3.text or ""
                         elif c3tag == "account":
                             isguid = child3.get("type")
                             if isguid == "guid":
@@ -937,12 +1339,26 @@ def gettransdata(elem, acctdict, splitdict, transdict, st):
                         acctname,
                         str(accttype),
                         str(sguid),
+                        scents,
+                        str(sacctguid),
+                        acctfullname(acctdict, sacctguid),
                     )
                     wholetrans.addsplit(split)
-    res = searchmatches(wholetrans, st)
-    if res == "y":
-        return ("y", wholetrans)
-    return ("n", wholetrans)
+    return wholetrans
+
+
+def acctfullname(acctdict, guid):
+    """The account name with all its parents,
+    like Expenses:Auto:Fuel. Root Account is left out."""
+    names = []
+    while guid != "" and len(names) < 100:
+        (name, etype, pguid, ourguid) = acctdict[guid]
+        if etype == "ROOT":
+            break
+        names += [str(name)]
+        guid = pguid
+    names.reverse()
+    return ":".join(names)
 
 
 def getacctdata(elem, acctdict):
@@ -975,19 +1391,19 @@ def getacctdata(elem, acctdict):
     #  <act:parent type="guid">97ff1d6efd522831b63a11754882b08b</act:parent>
 
     if ourguid == "":
-        print("Internal error. Nothing done")
-        sys.exit(1)
+        raise ValueError("Internal error. An account has no guid")
     else:
         acctdict[ourguid] = (ename, etype, pguid, ourguid)
 
 
-def getxml(content, countmax, st):
+def readbookxml(content, countmax, st):
+    """Parse the xml content.
+    Returns the account dict and a list of
+    every whole_transaction in book order."""
     root = ET.fromstring(content)
     count = 0
     acctdict = {}
-    splitdict = {}
-    transdict = {}
-    foundlist = []
+    translist = []
     if countmax == 0:
         # zero means all. So we hack in a 'big' count.
         countmax = 550000
@@ -999,207 +1415,3468 @@ def getxml(content, countmax, st):
                 getacctdata(child, acctdict)
                 continue
             if stag == "transaction":
-                if st._printacctnames:
-                    print_account_names(acctdict)
-                (yn, trans) = gettransdata(child, acctdict, splitdict, transdict, st)
-                if yn == "y":
-                    foundlist += [trans]
+                translist += [buildtrans(child, acctdict)]
+                if (len(translist) % 1000) == 0:
+                    progress({"phase": "parse",
+                        "transactions": len(translist)}, False)
                 continue
             count = int(count) + 1
             if int(count) > int(countmax):
-                print("stop i")
+                print("stop i", file=sys.stderr)
                 break
         count = int(count) + 1
         if int(count) > int(countmax):
-            print("stop o")
+            print("stop o", file=sys.stderr)
             break
+    return acctdict, translist
+
+
+def parsebook(content, countmax, st, parser):
+    """parser is "etree" or "expat"."""
+    if parser == "expat":
+        return readbookexpat(content, st)
+    return readbookxml(content, countmax, st)
+
+
+class expatbook:
+    """An expat state machine keeping just what getacctdata()
+    and buildtrans() would, as the cache records, with no
+    element objects at all.
+    Depth 3 is an account or transaction in the book,
+    4 their fields, 5 a date or a split, 6 split fields.
+    Empty fields are None, as an Element's text would be,
+    and become "" in the records as in buildtrans().
+    Text is only gathered inside a wanted field, by
+    pointing the parser's CharacterDataHandler at the
+    field's list, so the whitespace between elements
+    costs no Python call.
+    """
+    def __init__(self, st, p):
+        self._st = st
+        self._p = p
+        # account guid -> (short name, type, full name)
+        self._acctnames = {}
+        self._acctdict = {}
+        self._records = []
+        self._depth = 0
+        self._kind = None
+        self._field = None
+        self._outer = None
+        self._buf = None
+        self._names = {}
+        self._a = {}
+        self._t = {}
+        self._sp = {}
+        self._splits = []
+
+    def collect(self, field):
+        self._field = field
+        self._buf = []
+        self._p.CharacterDataHandler = self._buf.append
+
+    def local(self, name):
+        n = self._names.get(name)
+        if n is None:
+            n = name.rpartition(":")[2]
+            self._names[name] = n
+        return n
+
+    def start(self, name, attrs):
+        self._depth = int(self._depth) + 1
+        d = self._depth
+        if d == 3:
+            self._kind = self.local(name)
+            self._a = {}
+            self._t = {}
+            self._splits = []
+            return
+        kind = self._kind
+        if d == 4:
+            tag = self.local(name)
+            self._outer = tag
+            self._field = None
+            if kind == "account":
+                if tag in ("name", "type", "parent") or \
+                        (tag == "id" and attrs.get("type") == "guid"):
+                    self._field = tag
+            elif kind == "transaction":
+                if tag in ("num", "description") or \
+                        (tag == "id" and attrs.get("type") == "guid"):
+                    self._field = tag
+            if self._field:
+                self.collect(self._field)
+        elif d == 5 and kind == "transaction":
+            tag = self.local(name)
+            if tag == "split" and self._outer == "splits":
+                self._sp = {}
+            elif tag == "date" and self._outer in ("date-posted",
+                    "date-entered"):
+                self.collect(self._outer)
+        elif d == 6 and kind == "transaction" and \
+                self._outer == "splits":
+            tag = self.local(name)
+            if tag in ("id", "action", "value", "memo") or \
+                    (tag == "account" and attrs.get("type") == "guid"):
+                self.collect(tag)
+
+    def end(self, name):
+        d = self._depth
+        self._depth = int(d) - 1
+        if self._buf is not None:
+            text = None
+            if len(self._buf) > 0:
+                text = "".join(self._buf)
+            self._buf = None
+            self._p.CharacterDataHandler = None
+            if d == 6:
+                self._sp[self._field] = text
+            else:
+                self._t[self._field] = text
+                self._a[self._field] = text
+            self._field = None
+            return
+        if d == 5 and self._kind == "transaction" and \
+                self._outer == "splits":
+            self.endsplit()
+        elif d == 3:
+            if self._kind == "account":
+                self.endaccount()
+            elif self._kind == "transaction":
+                self.endtrans()
+            self._kind = None
+
+    def endaccount(self):
+        a = self._a
+        ourguid = a.get("id", "")
+        if ourguid == "":
+            raise ValueError("Internal error. An account has no guid")
+        self._acctdict[ourguid] = (a.get("name", ""), a.get("type", ""),
+            a.get("parent", ""), ourguid)
+
+    def endsplit(self):
+        sp = self._sp
+        acctdict = self._acctdict
+        sacctguid = sp.get("account", "")
+        names = self._acctnames.get(sacctguid)
+        if names is None:
+            accttype = acctdict[sacctguid][1]
+            names = (shortacctname(acctdict, sacctguid), str(accttype),
+                acctfullname(acctdict, sacctguid))
+            self._acctnames[sacctguid] = names
+        value = sp.get("value")
+        svalue = ""
+        scents = 0
+        if "value" in sp:
+            svalue = stdval(value)
+            scents = valcents(value)
+        self._splits += [(sp.get("memo") or "", sp.get("action") or "",
+            str(svalue), names[0], names[1],
+            str(sp.get("id", "")), scents, str(sacctguid), names[2])]
+
+    def endtrans(self):
+        t = self._t
+        posted = t.get("date-posted")
+        if posted is not None:
+            posted = datewithouttz(posted)
+        entered = t.get("date-entered")
+        if entered is not None:
+            entered = datewithouttz(entered)
+        self._records += [(posted or "", entered or "",
+            t.get("num") or "", t.get("description") or "",
+            str(t.get("id", "")), tuple(self._splits))]
+        if (len(self._records) % 1000) == 0:
+            progress({"phase": "parse",
+                "transactions": len(self._records)}, False)
+
+
+def readbookexpat(content, st):
+    """As readbookxml() but with expat, see expatbook."""
+    p = xml.parsers.expat.ParserCreate()
+    p.buffer_text = True
+    eb = expatbook(st, p)
+    p.StartElementHandler = eb.start
+    p.EndElementHandler = eb.end
+    p.Parse(content, True)
+    return eb._acctdict, [recordtotrans(r) for r in eb._records]
+
+
+def querycandidates(translist, st, tindex, aindex):
+    """Return the set of translist positions that could
+    match st, or None meaning all of them.
+    With an amount selection only the transactions the
+    amount_index finds are candidates, and with a
+    trigram_index only those that could hold every -s term.
+    Callers searching the same translist more than once
+    pass the amount_index, else aindex is None and one is
+    built for this search.
+    """
+    positions = None
+    if st.amountselected():
+        if aindex is None:
+            aindex = amount_index(translist)
+        positions = set(aindex.lookup(st))
+    if tindex:
+        tpos = tindex.lookup(st)
+        if tpos is not None:
+            if positions is None:
+                positions = tpos
+            else:
+                positions &= tpos
+    return positions
+
+
+def isodate(d):
+    """2022-02-24 10:59:00 as 2022-02-24T10:59:00"""
+    return d.strip().replace(" ", "T")
+
+
+CSVCOLUMNS = ["trans_guid", "posted", "entered", "num",
+    "description", "split_guid", "account", "account_guid",
+    "memo", "action", "amount_cents", "matched"]
+
+
+def splitmatched(w, s):
+    """Whether split s of w counts as matching. When only
+    the transaction matched, all of its splits do, as
+    wprint() marks them."""
+    if s._foundmatch:
+        return True
+    return not any([x._foundmatch for x in w._splits])
+
+
+def recorddict(w):
+    """The -format jsonl object for a whole_transaction."""
+    t = w._trans
+    splits = []
+    for s in w._splits:
+        splits += [{"guid": s._guid, "account": s._acctpath,
+            "account_guid": s._acctguid,
+            "memo": s._memo,
+            "action": s._chknum,
+            "amount_cents": s._cents,
+            "matched": splitmatched(w, s)}]
+    return {"guid": t._tguid,
+        "posted": t._dateposted.strip()[0:10],
+        "entered": isodate(t._dateentered),
+        "num": t._transactionnum,
+        "description": t._description,
+        "splits": splits}
+
+
+def writerecords(foundlist, st, book, header, out=None):
+    """Write the -format jsonl or csv records, with the
+    csv header line if header. A book (path) other than
+    False is added to every record, for multi-book searches.
+    Text is gathered into blocks so out (stdout if None)
+    is written a few thousand records at a time."""
+    if out is None:
+        out = sys.stdout
+    block = io.StringIO()
+    cw = None
+    first = []
+    if book is not False:
+        first = [book]
+    if st._outformat == "csv":
+        cw = csv.writer(block, lineterminator="\n")
+        if header:
+            if book is not False:
+                cw.writerow(["book"] + CSVCOLUMNS)
+            else:
+                cw.writerow(CSVCOLUMNS)
+    for (n, w) in enumerate(sorted(foundlist)):
+        t = w._trans
+        posted = t._dateposted.strip()[0:10]
+        entered = isodate(t._dateentered)
+        if cw:
+            for s in w._splits:
+                cw.writerow(first + [t._tguid, posted, entered,
+                    t._transactionnum,
+                    t._description,
+                    s._guid, s._acctpath, s._acctguid,
+                    s._memo, s._chknum,
+                    s._cents, int(splitmatched(w, s))])
+        else:
+            rec = recorddict(w)
+            if book is not False:
+                rec = dict([("book", book)] + list(rec.items()))
+            block.write(json.dumps(rec))
+            block.write("\n")
+        if (n % 2000) == 1999:
+            out.write(block.getvalue())
+            block.seek(0)
+            block.truncate()
+    out.write(block.getvalue())
+    out.flush()
+
+
+def printfound(foundlist, st, out=None):
+    """Print the report. Returns the account totals."""
     # So now print anything found.
-    print("Transactions count", len(foundlist))
+    progress({"phase": "report", "matches": len(foundlist)}, True)
+    if st._outformat != "text":
+        writerecords(foundlist, st, False, True, out)
+        return {}
+    print("Transactions count", len(foundlist), file=out)
     y = sorted(foundlist)
     acctsumdict = {}
     for w in y:
-        printtransmatch(w, st, acctsumdict)
+        printtransmatch(w, st, acctsumdict, out)
     if st._accountreport:
-        return
+        return {}
+    printacctsums(acctsumdict, out)
+    return acctsumdict
+
+
+def printacctsums(acctsumdict, out=None):
     keys = acctsumdict.keys()
     ksort = sorted(keys)
     if len(ksort) > 0:
-        print(" account                      total")
+        print(" account                      total", file=out)
     for k in ksort:
         v = float(acctsumdict[k])
         if 0.0 == v:
             continue
-        print("%-26s %7.2f" % (k, v))
+        print("%-26s %7.2f" % (k, v), file=out)
     return
 
 
-def quoted(s1, s2, s3):
-    q1 = "'" + str(hrutil.twodig(s1)) + "'"
-    q2 = "'" + str(hrutil.twodig(s2)) + "'"
-    q3 = "'" + str(hrutil.twodig(s3)) + "'"
-    return ",".join([q1, q2, q3])
+# The book cache and trigram index.
+# Both are pickles written next to the book and tagged with
+# the book size and modification time, so a changed
+# book means both get rebuilt on the next run.
+# Only plain tuples and dicts go in the pickles so that they
+# load no matter what name this module runs under.
+# The cache is a manifest (cashpath.sgcache) with the accounts
+# and, per posted year (or month), the transaction count and
+# the date bounds of a shard file (cashpath.sgcache.2022)
+# holding that year's records. A search by date reads only
+# the shards that could match, see searchterms.datebounds().
+# Within a shard the records are in blocks of BLOOMBLOCK
+# transactions, each pickled on its own beside a Bloom filter
+# of its trigrams, so blocks that cannot hold every -s term
+# are never unpickled.
+CACHEVERSION = 5
+CACHESUFFIX = ".sgcache"
+TRIGRAMSUFFIX = ".sgtri"
+# A shard per "year" or per "month", the length of the
+# posted date prefix naming it.
+SHARDLENS = {"year": 4, "month": 7}
+cacheshards = "year"
 
 
-def validateindex(i, lim, m):
-    if int(i) < int(lim):
-        return
-    print("Improper argument list, missing value for ", m)
-    usage("")
+def setshards(name):
+    global cacheshards
+    cacheshards = name
 
-def reportallafter(d,msg):
-    print("The",msg,"date is not in YYYY-MM-DD form or")
-    print(" a proper subset of that.");
-    print("It is, instead:",d);
-    usage("Date Error!")
-def validatedate(d,msg):
-    if len(d) < 4:
-        reportallafter(d,msg)
-    wds = d.split("-")
-    if len(wds) > 3:
-        reportallafter(d,msg)
-    w = wds[0]
-    if len(w) != 4:
-        reportallafter(d,msg)
-    if not w.isdigit():
-        reportallafter(d,msg)
-    if len(wds) < 2:
-        return
-    w = wds[1]
-    if len(w) != 2:
-        reportallafter(d,msg)
-    if not w.isdigit():
-        reportallafter(d,msg)
-    if len(wds) < 3:
-        return
-    w = wds[2]
-    if len(w) != 2:
-        reportallafter(d,msg)
-    if not w.isdigit():
-        reportallafter(d,msg)
-    return
 
-def readfor(f):
-    lall = f.readlines()
-    path = False
-    macos = False
-    for n,l in enumerate(lall):
-        l2 = l.strip()
-        if len(l2) < 1:
-            continue
-        if l2[0] == "#":
-            continue
-        if l2.startswith("filepath: "):
-            p=l2[10:]
-            p2 = p.strip()
-            if len(p2)  > 1:
-                path = p2;
-        if l2.startswith("macos:"):
-            macos = True
-    return path,macos
- 
-#   Reading the configure file for a full path
-def readconf():
-    ghome= os.getenv("HOME",None)
-    if not ghome:
-        print("No HOME env variable available to find searchgnucash.conf")
-        return False,False
-    confpath= os.path.join(ghome,"searchgnucash.conf")
+def transtorecord(w):
+    t = w._trans
+    splits = []
+    for s in w._splits:
+        splits += [(s._memo, s._chknum, s._value, s._acctname,
+            s._accttype, s._guid, s._cents, s._acctguid, s._acctpath)]
+    return (t._dateposted, t._dateentered, t._transactionnum,
+        t._description, t._tguid, tuple(splits))
+
+
+def recordtotrans(r):
+    (dateposted, dateentered, transnum, descr, tguid, splits) = r
+    wholetrans = whole_transaction()
+    wholetrans.add_transentry(transaction_entry(
+        dateposted, dateentered, transnum, descr, tguid))
+    for (memo, tnum, value, acctname, accttype, sguid, cents,
+        acctguid, acctpath) in splits:
+        split = split_entry()
+        split.add_splitdata(memo, tnum, value, acctname, accttype,
+            sguid, cents, acctguid, acctpath)
+        wholetrans.addsplit(split)
+    return wholetrans
+
+
+def transmarks(w):
+    """The marks searchmatches() left on w, as plain values."""
+    return (w._foundmatch, w._printallsplits, w._trans._foundmatch,
+        tuple([s._foundmatch for s in w._splits]))
+
+
+def setmarks(w, marks):
+    """Put back the transmarks() of w."""
+    (w._foundmatch, w._printallsplits, w._trans._foundmatch,
+        splitmarks) = marks
+    for (s, m) in zip(w._splits, splitmarks):
+        s._foundmatch = m
+
+
+def bookstamp(fname):
+    sb = os.stat(fname)
+    return (sb.st_size, sb.st_mtime_ns)
+
+
+def readpickle(path, stamp):
+    """Return the pickled dict if it is for this
+    version of the book, else False."""
     try:
-        f= open(confpath,"r")
-    except:
-        print("Cannot open",confpath)
-        return False,False
-    if not f:
-        print("Cannot open",confpath)
-        return False,False
-    path,macos= readfor(f)
+        with open(path, "rb") as f:
+            d = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return False
+    if not isinstance(d, dict):
+        return False
+    if d.get("version") != CACHEVERSION:
+        return False
+    if d.get("stamp") != stamp:
+        return False
+    return d
+
+
+def writepickle(path, d):
+    """Write via a temp file so a reader never sees half a file.
+    Failure to write (read-only directory, say) is not fatal."""
+    tmp = path + ".tmp%d" % os.getpid()
+    try:
+        with open(tmp, "wb") as f:
+            pickle.dump(d, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except OSError as e:
+        print("Unable to write", path, e, file=sys.stderr)
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+GZIPMAGIC = b"\x1f\x8b"
+
+
+def isgzipbook(fname):
+    """GnuCash compresses the XML unless told not to."""
+    with open(fname, "rb") as f:
+        return f.read(len(GZIPMAGIC)) == GZIPMAGIC
+
+
+def openbook(fname):
+    """A binary file object reading the book XML."""
+    if isgzipbook(fname):
+        return gzip.open(fname, "rb")
+    return open(fname, "rb")
+
+
+def readbookfile(fname):
+    """The book XML. An uncompressed book is mapped,
+    not read, so the parser works straight from the
+    page cache and no copy of the file is made."""
+    if not isgzipbook(fname):
+        with open(fname, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return b""
+            # The map stays valid after the file is closed.
+            content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        progress({"phase": "read", "bytes": size}, True)
+        return content
+    f = gzip.open(fname, "rb")
+    chunks = []
+    nbytes = 0
+    while True:
+        c = f.read(1 << 20)
+        if not c:
+            break
+        chunks += [c]
+        nbytes = int(nbytes) + len(c)
+        progress({"phase": "read", "bytes": nbytes}, False)
+    progress({"phase": "read", "bytes": nbytes}, True)
     f.close()
-    return path,macos 
+    return b"".join(chunks)
 
-if __name__ == "__main__":
-    searchstr = False
-    searchtermlist = []
-    dateselected = False
-    datetype = False 
-    # Changed splits default 2020-02-09
-    printallsplits = True
-    printallafter = False
-    onlytranslines = False
-    accountselect = False
-    printacctnames = False
-    accountreport = False
-    csvformat = False
-    fname = False
 
-    casesense = "n"
-    ct = 1
-    while int(ct) < len(sys.argv):
-        v = sys.argv[ct]
-        if v == "-h":
-            usage("-h:")
-        if v == "-csv":
-            csvformat = True
-        elif v == "-f":
-            ct = int(ct) + 1
-            validateindex(ct, len(sys.argv), "-f")
-            fname = sys.argv[ct]
-        elif v == "-datetype":
-            ct = int(ct) + 1
-            validateindex(ct, len(sys.argv), "-datetype")
-            if len(sys.argv[ct]) >= 1:
-                typed = sys.argv[ct]
-                if typed == "posted":
-                    datetype = typed
-                elif typed == "entered":
-                    datetype = typed
-                elif typed == "both":
-                    datetype = False
-                else:
-                    print("-datetype arg is ",typed, " which isnot allowed")
-        elif v == "-case":
-            ct = int(ct) + 1
-            validateindex(ct, len(sys.argv), "-case")
-            if len(sys.argv[ct]) >= 1:
-                icval = sys.argv[ct]
-                if int(icval) == 0:
-                    casesense = "n"
-                else:
-                    casesense = "y"
-        elif v == "-onlytranslines":
-            onlytranslines = "y"
-        elif v == "-printacctnames":
-            printacctnames = True
-        elif v == "-accountreport":
-            printallsplits = False
-            accountreport = True
-        elif v == "-accountselect":
-            ct = int(ct) + 1
-            validateindex(ct, len(sys.argv), "-accountselect")
-            accountselect = sys.argv[ct]
+def indexfold(s):
+    """Lower case for the trigram index.
+    Final sigma is folded too as str.lower() picks it by
+    context, which would make a term and the field
+    holding it lower-case differently."""
+    return s.lower().replace("\u03c2", "\u03c3")
+
+
+def trigrams(s, triset):
+    for k in range(len(s) - 2):
+        triset.add(s[k:k+3])
+
+
+def transtrigrams(w):
+    """Every field searchmatchtransaction() and searchmatchsplit()
+    look at is indexed, so the index never hides a match."""
+    t = w._trans
+    triset = set()
+    trigrams(indexfold(t._transactionnum), triset)
+    trigrams(indexfold(t._description), triset)
+    trigrams(indexfold(t._dateentered), triset)
+    for s in w._splits:
+        trigrams(indexfold(s._memo), triset)
+        trigrams(indexfold(s._acctname), triset)
+        trigrams(indexfold(s._value), triset)
+        trigrams(indexfold(s._chknum), triset)
+    return triset
+
+
+class trigram_index:
+    """For each trigram the sorted positions in translist
+    of transactions having it somewhere."""
+    def __init__(self, translist):
+        postings = {}
+        for (i, w) in enumerate(translist):
+            for tri in transtrigrams(w):
+                p = postings.get(tri)
+                if p is None:
+                    p = array("I")
+                    postings[tri] = p
+                p.append(i)
+        self._postings = postings
+
+    def lookupterm(self, term):
+        """Return a set of positions that might hold term,
+        or None if the term is too short to say."""
+        t = indexfold(term)
+        triset = set()
+        trigrams(t, triset)
+        if len(triset) == 0:
+            return None
+        plist = []
+        for tri in triset:
+            p = self._postings.get(tri)
+            if p is None:
+                return set()
+            plist += [p]
+        plist.sort(key=len)
+        found = set()
+        for i in plist[0]:
+            ok = True
+            for p in plist[1:]:
+                k = bisect.bisect_left(p, i)
+                if k == len(p) or p[k] != i:
+                    ok = False
+                    break
+            if ok:
+                found.add(i)
+        return found
+
+    def lookup(self, st):
+        """Return the set of candidate positions for the
+        st search terms, or None meaning look at everything."""
+        if st._accountselect:
+            # An -accountselect match ignores the -s terms.
+            return None
+        found = None
+        for term in st._printchecklist:
+            tf = self.lookupterm(term)
+            if tf is None:
+                continue
+            if found is None:
+                found = tf
+            else:
+                found &= tf
+        return found
+
+
+BLOOMBLOCK = 256
+# Bits per trigram and bit positions per trigram, about one
+# block in a hundred passes a trigram it does not have.
+BLOOMBITS = 10
+BLOOMHASHES = 7
+
+
+def bloombits(tri, nbits):
+    """The bit positions of a trigram, by double hashing."""
+    h = hashlib.blake2b(tri.encode("utf-8"), digest_size=8).digest()
+    a = int.from_bytes(h[0:4], "little")
+    b = int.from_bytes(h[4:8], "little") | 1
+    return [(a + i * b) % nbits for i in range(BLOOMHASHES)]
+
+
+def bloommake(triset):
+    """A Bloom filter of the trigrams, as (nbits, bytes)."""
+    nbits = max(64, len(triset) * BLOOMBITS)
+    bits = bytearray((nbits + 7) // 8)
+    for tri in triset:
+        for k in bloombits(tri, nbits):
+            bits[k >> 3] |= 1 << (k & 7)
+    return (nbits, bytes(bits))
+
+
+def bloomhas(bloom, tri):
+    (nbits, bits) = bloom
+    for k in bloombits(tri, nbits):
+        if not bits[k >> 3] & (1 << (k & 7)):
+            return False
+    return True
+
+
+def bloomterms(st):
+    """The trigrams of each -s term long enough to have
+    any, as trigram_index.lookup() would use them."""
+    if st._accountselect:
+        # An -accountselect match ignores the -s terms.
+        return []
+    terms = []
+    for term in st._printchecklist:
+        triset = set()
+        trigrams(indexfold(term), triset)
+        if len(triset) > 0:
+            terms += [triset]
+    return terms
+
+
+def bloomblock(bloom, terms):
+    """False if the block cannot hold every term."""
+    for triset in terms:
+        for tri in triset:
+            if not bloomhas(bloom, tri):
+                return False
+    return True
+
+
+def shardpath(cpath, key):
+    if key == "":
+        key = "nodate"
+    return cpath + "." + key
+
+
+def writeshards(fname, cpath, stamp, acctdict, translist):
+    """Write the cache manifest and shards. Returns translist
+    in shard order, the order a full read of the shards
+    gives and so the one the trigram index must use."""
+    shards = {}
+    for w in translist:
+        key = w._trans._dateposted.strip()[0:SHARDLENS[cacheshards]]
+        shards.setdefault(key, []).append(w)
+    manifest = []
+    ordered = []
+    for key in sorted(shards.keys()):
+        lst = shards[key]
+        posted = [w._trans._dateposted.strip()[0:10] for w in lst]
+        entered = [w._trans._dateentered.strip()[0:10] for w in lst]
+        manifest += [(key, len(lst), min(posted), max(posted),
+            min(entered), max(entered))]
+        blocks = []
+        for k in range(0, len(lst), BLOOMBLOCK):
+            triset = set()
+            for w in lst[k:k+BLOOMBLOCK]:
+                triset |= transtrigrams(w)
+            records = [transtorecord(w) for w in lst[k:k+BLOOMBLOCK]]
+            blocks += [(bloommake(triset), len(records),
+                pickle.dumps(records, pickle.HIGHEST_PROTOCOL))]
+        writepickle(shardpath(cpath, key), {"version": CACHEVERSION,
+            "stamp": stamp, "blocks": blocks})
+        ordered += lst
+    # Shards of an earlier layout would only take up space.
+    keep = set([shardpath(cpath, m[0]) for m in manifest])
+    for old in glob.glob(glob.escape(cpath) + ".*"):
+        if old not in keep and ".tmp" not in old:
+            try:
+                os.unlink(old)
+            except OSError:
+                pass
+    writepickle(cpath, {"version": CACHEVERSION, "stamp": stamp,
+        "acctdict": acctdict, "shards by": cacheshards,
+        "shards": manifest})
+    return ordered
+
+
+def readshards(cpath, stamp, st, prune, useblooms):
+    """acctdict, translist and whether every transaction was
+    read, from the cache, or None if the cache is not current.
+    With prune only the shards whose date bounds could
+    match st are read, and with useblooms too only the
+    blocks whose Bloom filters have every -s term."""
+    d = readpickle(cpath, stamp)
+    if not d or d["shards by"] != cacheshards:
+        return None
+    terms = []
+    if prune and useblooms:
+        terms = bloomterms(st)
+    translist = []
+    every = True
+    for (key, count, plo, phi, elo, ehi) in d["shards"]:
+        if prune and not st.datebounds(plo, phi, elo, ehi):
+            every = False
+            continue
+        sd = readpickle(shardpath(cpath, key), stamp)
+        if not sd or sum([b[1] for b in sd["blocks"]]) != count:
+            return None
+        for (bloom, n, blob) in sd["blocks"]:
+            if not bloomblock(bloom, terms):
+                every = False
+                continue
+            translist += [recordtotrans(r) for r in pickle.loads(blob)]
+    return d["acctdict"], translist, every
+
+
+def loadbook(fname, countmax, st, usecache, useindex, prune, parser):
+    """Return acctdict, translist and the trigram_index
+    (or None) for the book, via the cache files if asked.
+    With prune only transactions that could match the st
+    dates and terms are returned (those the sqlite query
+    picks, or those in the cache shards and blocks), for
+    searches that need nothing else."""
+    if issqlbook(fname):
+        # The database needs no cache files.
+        acctdict, translist = loadsqlbook(fname, st, prune)
+        return acctdict, translist, None
+    if not usecache and not useindex:
+        content = readbookfile(fname)
+        acctdict, translist = parsebook(content, countmax, st, parser)
+        return acctdict, translist, None
+    stamp = bookstamp(fname)
+    cpath = fname + CACHESUFFIX
+    # The trigram index, when there is one, does better
+    # than the Bloom filters.
+    d = readshards(cpath, stamp, st, prune, not useindex)
+    if d:
+        (acctdict, translist, every) = d
+        if not every:
+            # The trigram index is of the whole book.
+            return acctdict, translist, None
+    else:
+        content = readbookfile(fname)
+        acctdict, translist = parsebook(content, countmax, st, parser)
+        translist = writeshards(fname, cpath, stamp, acctdict,
+            translist)
+    if not useindex:
+        return acctdict, translist, None
+    tpath = fname + TRIGRAMSUFFIX
+    d = readpickle(tpath, stamp)
+    tindex = trigram_index([])
+    # Year and month shards put translist in different orders.
+    if d and d["shards by"] == cacheshards:
+        tindex._postings = d["postings"]
+    else:
+        tindex = trigram_index(translist)
+        writepickle(tpath, {"version": CACHEVERSION, "stamp": stamp,
+            "shards by": cacheshards, "postings": tindex._postings})
+    return acctdict, translist, tindex
+
+
+SQLITEMAGIC = b"SQLite format 3\x00"
+
+
+def issqlbook(fname):
+    """True if fname is a book saved with the GnuCash
+    sqlite backend rather than as (gzip'd) XML."""
+    try:
+        with open(fname, "rb") as f:
+            return f.read(len(SQLITEMAGIC)) == SQLITEMAGIC
+    except OSError:
+        return False
+
+
+def sqldate(d):
+    """GnuCash 2.6 wrote 20190101105900, later versions
+    2019-01-01 10:59:00. Return the latter, as
+    datewithouttz() does for XML."""
+    if d is None:
+        return ""
+    if len(d) == 14 and d.isdigit():
+        return "%s-%s-%s %s:%s:%s" % (d[0:4], d[4:6], d[6:8],
+            d[8:10], d[10:12], d[12:14])
+    return d[0:19]
+
+
+def sqllike(term):
+    """A LIKE pattern for term anywhere in a field."""
+    t = term.replace("\\", "\\\\").replace("%", "\\%")
+    return "%" + t.replace("_", "\\_") + "%"
+
+
+def sqlwhere(con, acctdict, st):
+    """Turn the search options into conditions on
+    transactions t, as (list of sql, list of params).
+    Every condition only ever lets through more than
+    searchmatches() would, which still decides, so
+    anything awkward to say in SQL is simply left out."""
+    where = []
+    params = []
+    row = con.execute("SELECT post_date FROM transactions"
+        " LIMIT 1").fetchone()
+    isodates = row is None or row[0] is None or "-" in row[0]
+    if isodates and (st._dateselected or st._printallafter):
+        cols = ["t.post_date", "t.enter_date"]
+        if st._datetype == "posted":
+            cols = ["t.post_date"]
+        elif st._datetype == "entered":
+            cols = ["t.enter_date"]
+        ors = []
+        for c in cols:
+            if st._dateselected:
+                # The date begins with -d.
+                ors += ["(%s >= ? AND %s < ?)" % (c, c)]
+                params += [st._dateselected,
+                    st._dateselected + "\uffff"]
+            else:
+                ors += ["%s >= ?" % c]
+                params += [st._printallafter]
+        where += ["(" + " OR ".join(ors) + ")"]
+    if st.amountselected():
+        v = "(s.value_num * 100.0 / s.value_denom)"
+        low = st._amountlow
+        high = st._amounthigh
+        if st._amountabs:
+            v = "abs" + v
+            if low is not False and low < 0:
+                low = False
+        ands = []
+        # A cent either way for rounding.
+        if low is not False:
+            ands += [v + " >= ?"]
+            params += [low - 1]
+        if high is not False:
+            ands += [v + " <= ?"]
+            params += [high + 1]
+        if len(ands) > 0:
+            where += ["EXISTS (SELECT 1 FROM splits s WHERE"
+                " s.tx_guid = t.guid AND " + " AND ".join(ands) + ")"]
+    if st._accountselect:
+        # With -s terms and no -accountreport a split matching
+        # a term also counts, see searchmatches(), so
+        # only the plain account selection is pushed down.
+        if st._accountreport or len(st._searchchecklist) == 0:
+            us = actic(st._accountselect, st)
+            guids = [g for g in acctdict.keys()
+                if actic(shortacctname(acctdict, g), st) == us]
+            if len(guids) == 0:
+                return ["0"], []
+            where += ["EXISTS (SELECT 1 FROM splits s WHERE"
+                " s.tx_guid = t.guid AND s.account_guid IN (%s))"
+                % ",".join(["?"] * len(guids))]
+            params += guids
+        return where, params
+    if not isodates:
+        # The entered date is matched as text.
+        return where, params
+    for term in st._printchecklist:
+        if not term.isascii() or term.strip("0123456789.-") == "":
+            # LIKE folds only ascii case, and a number
+            # could match a split value as stdval() shows it.
+            continue
+        lt = term.lower()
+        guids = [g for g in acctdict.keys()
+            if lt in shortacctname(acctdict, g).lower()]
+        p = sqllike(term)
+        acct = ""
+        if len(guids) > 0:
+            acct = " OR s.account_guid IN (%s)" % ",".join(
+                ["?"] * len(guids))
+        where += ["(t.num LIKE ? ESCAPE '\\'"
+            " OR t.description LIKE ? ESCAPE '\\'"
+            " OR t.enter_date LIKE ? ESCAPE '\\'"
+            " OR EXISTS (SELECT 1 FROM splits s WHERE"
+            " s.tx_guid = t.guid AND (s.memo LIKE ? ESCAPE '\\'"
+            " OR s.action LIKE ? ESCAPE '\\'" + acct + ")))"]
+        params += [p, p, p, p, p] + guids
+    return where, params
+
+
+def loadsqlbook(fname, st, pushdown):
+    """Return acctdict and translist for a sqlite book.
+    With pushdown only the transactions the search
+    options could match are read from the database."""
+    con = sqlite3.connect(fname)
+    con.execute("PRAGMA query_only = ON")
+    rows = con.execute("SELECT guid, name, account_type,"
+        " parent_guid FROM accounts").fetchall()
+    parents = {}
+    for (guid, name, atype, pguid) in rows:
+        parents[guid] = pguid
+    # Scheduled transaction templates hang off their own root.
+    troots = set([r[0] for r in con.execute(
+        "SELECT root_template_guid FROM books").fetchall()])
+    template = set()
+    for (guid, name, atype, pguid) in rows:
+        g = guid
+        depth = 0
+        while g is not None and g not in troots and depth < 100:
+            g = parents.get(g)
+            depth = int(depth) + 1
+        if g is not None and g in troots:
+            template.add(guid)
+    acctdict = {}
+    for (guid, name, atype, pguid) in rows:
+        if guid not in template:
+            acctdict[guid] = (name, atype, pguid or "", guid)
+    where = []
+    params = []
+    if len(template) > 0:
+        where += ["t.guid NOT IN (SELECT tx_guid FROM splits"
+            " WHERE account_guid IN (%s))" % ",".join(
+            ["?"] * len(template))]
+        params += sorted(template)
+    if pushdown:
+        w, p = sqlwhere(con, acctdict, st)
+        where += w
+        params += p
+    cond = ""
+    if len(where) > 0:
+        cond = " WHERE " + " AND ".join(where)
+    translist = []
+    byguid = {}
+    for (guid, num, posted, entered, descr) in con.execute(
+            "SELECT t.guid, t.num, t.post_date, t.enter_date,"
+            " t.description FROM transactions t" + cond +
+            " ORDER BY t.post_date, t.enter_date", params):
+        wholetrans = whole_transaction()
+        wholetrans.add_transentry(transaction_entry(sqldate(posted),
+            sqldate(entered), str(num or ""), str(descr or ""),
+            str(guid)))
+        byguid[guid] = wholetrans
+        translist += [wholetrans]
+        if (len(translist) % 1000) == 0:
+            progress({"phase": "parse",
+                "transactions": len(translist)}, False)
+    for (tguid, sguid, memo, action, vnum, vdenom, sacctguid) in \
+            con.execute("SELECT s.tx_guid, s.guid, s.memo, s.action,"
+            " s.value_num, s.value_denom, s.account_guid FROM splits s"
+            " WHERE s.tx_guid IN (SELECT t.guid FROM transactions t"
+            + cond + ")", params):
+        wholetrans = byguid.get(tguid)
+        if wholetrans is None:
+            continue
+        vtext = "%d/%d" % (vnum, vdenom)
+        (acctname, accttype, parentguid, ourguid) = acctdict[sacctguid]
+        split = split_entry()
+        split.add_splitdata(
+            str(memo or ""),
+            str(action or ""),
+            str(stdval(vtext)),
+            shortacctname(acctdict, sacctguid),
+            str(accttype),
+            str(sguid),
+            valcents(vtext),
+            str(sacctguid),
+            acctfullname(acctdict, sacctguid),
+        )
+        wholetrans.addsplit(split)
+    con.close()
+    return acctdict, translist
+
+
+def searchbook(fname, st, usecache, useindex, parser, shards):
+    """Load and search one book of a multi-book search.
+    Runs in a worker process, so returns plain records,
+    their transmarks() and the split_balances of their
+    splits, or an error message."""
+    setshards(shards)
+    try:
+        book = Book.open(fname, usecache, useindex, parser, st)
+        foundlist = list(book.matches(st))
+        balances = {}
+        if st.wantsbalances():
+            bi = book.balanceindex()
+            for w in foundlist:
+                for s in w._splits:
+                    balances[s._guid] = bi.runningbalance(w._trans, s)
+    except Exception as e:
+        # Whatever is wrong with one book, report it and go on
+        # with the others.
+        return "%s: %s" % (type(e).__name__, e)
+    return ([transtorecord(w) for w in foundlist],
+        [transmarks(w) for w in foundlist], balances)
+
+
+def searchbooks(fnames, st, usecache, useindex, parser):
+    """Search every book at once in a process pool, then
+    report each book in turn and the totals of all.
+    Returns the number of books that could not be searched."""
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor() as ex:
+        futs = {}
+        for f in fnames:
+            futs[f] = ex.submit(searchbook, f, st, usecache, useindex,
+                parser, cacheshards)
+        done = 0
+        for fut in concurrent.futures.as_completed(list(futs.values())):
+            done = int(done) + 1
+            progress({"phase": "books", "books": len(fnames),
+                "done": done}, False)
+        for f in fnames:
+            results[f] = futs[f].result()
+    overall = {}
+    total = 0
+    failed = 0
+    header = True
+    for f in fnames:
+        r = results[f]
+        if isinstance(r, str):
+            print("Cannot search", f, r, file=sys.stderr)
+            failed = int(failed) + 1
+            continue
+        (records, marks, balances) = r
+        foundlist = [recordtotrans(x) for x in records]
+        for (w, m) in zip(foundlist, marks):
+            setmarks(w, m)
+        if st.wantsbalances():
+            st._balanceindex = split_balances(balances)
+        total += len(foundlist)
+        if st._outformat != "text":
+            writerecords(foundlist, st, f, header)
+            header = False
+            continue
+        print("")
+        print("Book          :", f)
+        sums = printfound(foundlist, st)
+        for key in sums.keys():
+            overall[key] = float(overall.get(key, 0.0)) + float(sums[key])
+    progress({"phase": "done", "matches": total}, True)
+    if st._outformat != "text":
+        return failed
+    print("")
+    print("All books     : %d searched, %d failed" %
+        (len(fnames) - failed, failed))
+    print("Transactions count", total)
+    if not st._accountreport:
+        printacctsums(overall)
+    return failed
+
+
+GNCNS = "{http://www.gnucash.org/XML/gnc}"
+TRNNS = "{http://www.gnucash.org/XML/trn}"
+
+
+def iterbooktrans(fname, acctdict):
+    """Yield each book-level whole_transaction of the file
+    without building the whole element tree, filling
+    acctdict as the accounts go by.
+    Elements below the book (template transactions
+    and such) are ignored, as in readbookxml()."""
+    f = openbook(fname)
+    depth = 0
+    stack = []
+    for (event, elem) in ET.iterparse(f, events=("start", "end")):
+        if event == "start":
+            depth = int(depth) + 1
+            stack += [elem]
+            continue
+        depth = int(depth) - 1
+        stack.pop()
+        if depth != 2:
+            continue
+        if elem.tag == GNCNS + "account":
+            getacctdata(elem, acctdict)
+        elif elem.tag == GNCNS + "transaction":
+            yield buildtrans(elem, acctdict)
+        # Done with it, drop it from the book element.
+        stack[-1].remove(elem)
+    f.close()
+
+
+def diffcanon(w):
+    """The transaction as a tuple with the splits in guid
+    order, so GnuCash reordering splits is not a change."""
+    r = transtorecord(w)
+    return r[:5] + (tuple(sorted(r[5], key=lambda x: x[5])),)
+
+
+def diffdigest(w):
+    return hashlib.blake2b(repr(diffcanon(w)).encode("utf-8"),
+        digest_size=16).digest()
+
+
+def diffdigests(fname):
+    """guid -> digest for every transaction in the file"""
+    digests = {}
+    for w in iterbooktrans(fname, {}):
+        digests[w._trans._tguid] = diffdigest(w)
+    return digests
+
+
+def difffield(name, old, new):
+    if old == new:
+        return
+    print("   %-22s: %s -> %s" % (name, quoteme(old), quoteme(new)))
+
+
+def diffsplits(wa, wb):
+    sa = {}
+    for s in wa._splits:
+        sa[s._guid] = s
+    sb = {}
+    for s in wb._splits:
+        sb[s._guid] = s
+    for g in sorted(sa.keys()):
+        if g not in sb:
+            s = sa[g]
+            print("   split %s removed: %s %s %s" % (g,
+                quoteme(s._memo.strip()), centsstr(s._cents),
+                s._acctname))
+            continue
+        a = sa[g]
+        b = sb[g]
+        difffield("split %s memo" % g[0:8], a._memo, b._memo)
+        difffield("split %s num" % g[0:8], a._chknum, b._chknum)
+        difffield("split %s value" % g[0:8], centsstr(a._cents),
+            centsstr(b._cents))
+        difffield("split %s account" % g[0:8], a._acctname, b._acctname)
+    for g in sorted(sb.keys()):
+        if g not in sa:
+            s = sb[g]
+            print("   split %s added: %s %s %s" % (g,
+                quoteme(s._memo.strip()), centsstr(s._cents),
+                s._acctname))
+
+
+def diffbooks(fnamea, fnameb, st):
+    """Report the transactions of fnameb added, removed or
+    changed relative to fnamea.
+    Pass one keeps only a small digest per transaction of b.
+    Pass two streams a and keeps just the old versions of
+    what differs. Pass three (only if anything was added or
+    changed) streams b again for the new versions.
+    So memory is O(size of b), the digests, plus the
+    differences: the books are not in guid order, so there
+    is no merging them as two sorted streams."""
+    digestsb = diffdigests(fnameb)
+    removed = []
+    changed = {}
+    unchanged = 0
+    for w in iterbooktrans(fnamea, {}):
+        g = w._trans._tguid
+        db = digestsb.pop(g, None)
+        if db is None:
+            removed += [w]
+        elif db != diffdigest(w):
+            changed[g] = w
+        else:
+            unchanged = int(unchanged) + 1
+    # Whatever is left in b was not in a.
+    addedguids = digestsb
+    added = []
+    changedpairs = []
+    if len(addedguids) > 0 or len(changed) > 0:
+        for w in iterbooktrans(fnameb, {}):
+            g = w._trans._tguid
+            if g in addedguids:
+                added += [w]
+            elif g in changed:
+                changedpairs += [(changed[g], w)]
+    # Report only differences the search options select,
+    # in either version.
+    added = [w for w in added if searchmatches(w, st) == "y"]
+    removed = [w for w in removed if searchmatches(w, st) == "y"]
+    changedpairs = [(a, b) for (a, b) in changedpairs
+        if searchmatches(a, st) == "y" or searchmatches(b, st) == "y"]
+    print("Diff of      :", fnamea)
+    print("     to      :", fnameb)
+    print("Transactions added %d removed %d changed %d unchanged %d" %
+        (len(added), len(removed), len(changedpairs), unchanged))
+    for w in sorted(removed):
+        print("")
+        print("Removed guid", w._trans._tguid, end='')
+        w._trans.tprint(st)
+    for w in sorted(added):
+        print("")
+        print("Added guid", w._trans._tguid, end='')
+        w._trans.tprint(st)
+    changedpairs.sort(key=lambda x: x[1])
+    for (a, b) in changedpairs:
+        print("")
+        print("Changed guid", b._trans._tguid, end='')
+        b._trans.tprint(st)
+        difffield("posted", a._trans._dateposted, b._trans._dateposted)
+        difffield("entered", a._trans._dateentered, b._trans._dateentered)
+        difffield("num", a._trans._transactionnum, b._trans._transactionnum)
+        difffield("description", a._trans._description,
+            b._trans._description)
+        diffsplits(a, b)
+
+
+# What badfield() considers bad, for a whole field at once.
+BADCHARS = re.compile("[^\x20-\x7e]")
+
+
+def validatetext(elem, guid, problems):
+    """Check the text of every leaf element below elem."""
+    for e in elem.iter():
+        t = e.text
+        if t is None or len(e) > 0:
+            continue
+        m = BADCHARS.search(t)
+        if m:
+            bad = sorted(set(BADCHARS.findall(t)))
+            problems += [("badchar", guid, shorttag(e.tag),
+                "%d newlines, chars %s" % (t.count("\n"),
+                " ".join(["%#x" % ord(c) for c in bad[0:8]])))]
+
+
+def validatebook(fname):
+    """One streaming pass over the whole book.
+    Returns a list of (problem, guid, field, detail)."""
+    problems = []
+    seen = {}
+    # (account guid, what refers to it, its guid)
+    acctrefs = []
+    accounts = set()
+    ntrans = 0
+    f = openbook(fname)
+    depth = 0
+    stack = []
+    events = ET.iterparse(f, events=("start", "end"))
+    while True:
+        try:
+            (event, elem) = next(events)
+        except StopIteration:
+            break
+        except ET.ParseError as e:
+            # Nothing after this can be read.
+            problems += [("xmlerror", "", "", str(e))]
+            break
+        if event == "start":
+            depth = int(depth) + 1
+            stack += [elem]
+            continue
+        depth = int(depth) - 1
+        stack.pop()
+        if depth != 2:
+            continue
+        tag = shorttag(elem.tag)
+        guid = ""
+        for child in elem:
+            if shorttag(child.tag) == "id":
+                guid = str(child.text)
+                break
+        if tag == "account":
+            accounts.add(guid)
+            for child in elem:
+                if shorttag(child.tag) == "parent":
+                    acctrefs += [(str(child.text), "parent", guid)]
+        elif tag == "transaction":
+            ntrans = int(ntrans) + 1
+            cents = 0
+            for split in elem.iter(TRNNS + "split"):
+                sguid = ""
+                for child in split:
+                    ctag = shorttag(child.tag)
+                    if ctag == "id":
+                        sguid = str(child.text)
+                    elif ctag == "value":
+                        cents += valcents(child.text)
+                    elif ctag == "account":
+                        acctrefs += [(str(child.text), "split", guid)]
+                if sguid in seen:
+                    problems += [("duplicate", sguid, "split",
+                        "also a %s" % seen[sguid])]
+                else:
+                    seen[sguid] = "split"
+            if cents != 0:
+                problems += [("unbalanced", guid, "value",
+                    "splits sum to %s" % centsstr(cents))]
+            if (ntrans % 1000) == 0:
+                progress({"phase": "validate",
+                    "transactions": ntrans}, False)
+        if guid != "":
+            if guid in seen:
+                problems += [("duplicate", guid, tag,
+                    "also a %s" % seen[guid])]
+            else:
+                seen[guid] = tag
+        validatetext(elem, guid, problems)
+        stack[-1].remove(elem)
+    f.close()
+    # Accounts may be anywhere in the book.
+    for (aguid, what, guid) in acctrefs:
+        if aguid not in accounts:
+            problems += [("noaccount", guid, what,
+                "account %s not in book" % aguid)]
+    progress({"phase": "validate", "transactions": ntrans}, True)
+    return problems
+
+
+def printvalidation(fname, problems, st):
+    """The -validate report, one problem per line or record.
+    Returns the exit status."""
+    cols = ["problem", "guid", "field", "detail"]
+    if st._outformat == "jsonl":
+        for p in problems:
+            print(json.dumps(dict(zip(cols, p))))
+    elif st._outformat == "csv":
+        cw = csv.writer(sys.stdout, lineterminator="\n")
+        cw.writerow(cols)
+        for p in problems:
+            cw.writerow(p)
+    else:
+        counts = {}
+        for p in problems:
+            counts[p[0]] = int(counts.get(p[0], 0)) + 1
+        print("Validated    :", fname)
+        print("Problems     :", len(problems), " ".join(
+            ["%s %d" % (k, counts[k]) for k in sorted(counts)]))
+        for p in problems:
+            print("%-10s %-32s %-12s %s" % p)
+    if len(problems) > 0:
+        return 1
+    return 0
+
+
+HISTORYSUFFIX = ".sghist"
+
+
+def historyversions(fname):
+    """Return [(label, path)] of the GnuCash backups of
+    fname, oldest first, then fname itself."""
+    versions = []
+    for path in glob.glob(glob.escape(fname) + ".*.gnucash"):
+        ts = path[len(fname)+1:-len(".gnucash")]
+        if len(ts) != 14 or not ts.isdigit():
+            continue
+        label = "%s-%s-%s %s:%s:%s" % (ts[0:4], ts[4:6], ts[6:8],
+            ts[8:10], ts[10:12], ts[12:14])
+        versions += [(label, path)]
+    versions.sort()
+    mt = datetime.fromtimestamp(os.path.getmtime(fname))
+    versions += [(mt.strftime("%Y-%m-%d %H:%M:%S"), fname)]
+    return versions
+
+
+def versiondigest(digests):
+    h = hashlib.blake2b(digest_size=16)
+    for g in sorted(digests.keys()):
+        h.update(g.encode("utf-8"))
+        h.update(digests[g])
+    return h.digest()
+
+
+def cachedversiondigest(path):
+    """The version digest from path's .sghist file, or False"""
+    d = readpickle(path + HISTORYSUFFIX, bookstamp(path))
+    if not d:
+        return False
+    return d["versiondigest"]
+
+
+def printtranslines(w, st):
+    """The transaction line and all its split lines"""
+    w._trans.tprint(st)
+    for s in w._splits:
+        s.sprint("", {}, st)
+
+
+def historyversion(path, st):
+    """Search one version of the book.
+    Runs in a worker process, so returns plain records.
+    Returns the version digest and, for each matching
+    transaction, guid -> (digest, record)."""
+    digests = {}
+    matches = {}
+    stamp = bookstamp(path)
+    for w in iterbooktrans(path, {}):
+        g = w._trans._tguid
+        d = diffdigest(w)
+        digests[g] = d
+        if searchmatches(w, st) == "y":
+            matches[g] = (d, transtorecord(w))
+    vd = versiondigest(digests)
+    writepickle(path + HISTORYSUFFIX, {"version": CACHEVERSION,
+        "stamp": stamp, "versiondigest": vd, "digests": digests})
+    return vd, matches
+
+
+def historybooks(fname, st):
+    versions = historyversions(fname)
+    # A version whose cached digest equals the one before
+    # it holds the same transactions, nothing to search.
+    tosearch = []
+    lastvd = False
+    for (label, path) in versions:
+        vd = cachedversiondigest(path)
+        if vd and vd == lastvd:
+            continue
+        lastvd = vd
+        tosearch += [(label, path)]
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor() as ex:
+        futs = {}
+        for (label, path) in tosearch:
+            futs[path] = ex.submit(historyversion, path, st)
+        for path in futs.keys():
+            results[path] = futs[path].result()
+    print("History of   :", fname)
+    print("Versions     : %d (%d skipped as unchanged)" %
+        (len(versions), len(versions) - len(tosearch)))
+    # Walk the versions oldest first noting, per transaction,
+    # where it first matched, changed, or stopped matching.
+    events = {}
+    latest = {}
+    lastmatch = {}
+    lastvd = False
+    for (n, (label, path)) in enumerate(versions):
+        print(" v%-3d %s %s" % (n+1, label, path))
+        if path not in results:
+            continue
+        vd, matches = results[path]
+        if vd == lastvd:
+            continue
+        lastvd = vd
+        for g in matches.keys():
+            (d, r) = matches[g]
+            if g not in lastmatch:
+                what = "appears"
+                if g in events:
+                    what = "reappears"
+            elif lastmatch[g] != d:
+                what = "changed"
+            else:
+                continue
+            events.setdefault(g, []).append((n+1, label, what, r))
+            latest[g] = r
+        for g in lastmatch.keys():
+            if g not in matches:
+                events[g].append((n+1, label,
+                    "gone (deleted or no longer matches)", None))
+        lastmatch = {}
+        for g in matches.keys():
+            lastmatch[g] = matches[g][0]
+    print("Transactions :", len(events))
+    glist = sorted(events.keys(), key=lambda g: recordtotrans(latest[g]))
+    for g in glist:
+        print("")
+        print("Trans guid", g)
+        for (n, label, what, r) in events[g]:
+            print(" v%-3d %s %s" % (n, label, what))
+            if r is None:
+                continue
+            printtranslines(recordtotrans(r), st)
+
+
+def watchscan(fname, querylist, olddigests):
+    """Read the book, returning the digest of every transaction
+    and a list of (what, query number, whole_transaction) for
+    matches that are new or changed since olddigests.
+    Unchanged transactions are not searched again."""
+    digests = {}
+    newmatches = []
+    for w in iterbooktrans(fname, {}):
+        g = w._trans._tguid
+        d = diffdigest(w)
+        digests[g] = d
+        od = olddigests.get(g)
+        if od == d:
+            continue
+        what = "Changed match"
+        if od is None:
+            what = "New match"
+        for (k, (label, st, outpath)) in enumerate(querylist):
+            w.clearmatch()
+            if searchmatches(w, st) == "y":
+                newmatches += [(what, k, w)]
+    return digests, newmatches
+
+
+def watchbook(fname, querylist, interval):
+    stamp = bookstamp(fname)
+    digests, newmatches = watchscan(fname, querylist, {})
+    foundlists = [[] for q in querylist]
+    for (what, k, w) in newmatches:
+        foundlists[k] += [w]
+    printqueryreports(querylist, foundlists, fname)
+    print("Watching     :", fname, curtime(), flush=True)
+    while True:
+        sleep(interval)
+        try:
+            ns = bookstamp(fname)
+        except OSError:
+            # GnuCash renames files as it saves.
+            continue
+        if ns == stamp:
+            continue
+        # Let the save finish before reading.
+        sleep(interval)
+        try:
+            if bookstamp(fname) != ns:
+                continue
+            newdigests, newmatches = watchscan(fname, querylist, digests)
+        except (OSError, EOFError, ET.ParseError) as e:
+            # Likely caught mid-save, try again next time.
+            print("Unable to read", fname, e, curtime(), flush=True)
+            continue
+        stamp = ns
+        removed = 0
+        for g in digests.keys():
+            if g not in newdigests:
+                removed = int(removed) + 1
+        changed = 0
+        for g in newdigests.keys():
+            if digests.get(g) != newdigests[g]:
+                changed = int(changed) + 1
+        digests = newdigests
+        print("")
+        print("Book saved   : %s transactions new or changed %d removed %d"\
+            " matches %d" % (curtime(), changed, removed, len(newmatches)))
+        for (what, k, w) in sorted(newmatches, key=lambda x: (x[1], x[2])):
+            (label, st, outpath) = querylist[k]
+            if label:
+                print(label)
+            print(what, "guid", w._trans._tguid, end='')
+            printtranslines(w, st)
+        sys.stdout.flush()
+
+
+def readqueries(qpath):
+    """Return [(label, st, outpath)] from the -queries file."""
+    querylist = []
+    try:
+        f = open(qpath, "r")
+    except OSError as e:
+        print("Cannot open", qpath, e)
+        sys.exit(1)
+    lall = f.readlines()
+    f.close()
+    for (n, l) in enumerate(lall):
+        l2 = l.strip()
+        if len(l2) < 1:
+            continue
+        if l2[0] == "#":
+            continue
+        label = "Query line %d: %s" % (int(n)+1, l2)
+        try:
+            args = shlex.split(l2)
+        except ValueError as e:
+            print(label)
+            usage("Bad quoting in -queries line: %s" % e)
+        outpath = False
+        if "-o" in args:
+            k = args.index("-o")
+            if k + 1 >= len(args):
+                print(label)
+                usage("-o needs an output path")
+            outpath = args[k+1]
+            del args[k:k+2]
+        opts = parseargs(args)
+        bad = [m for m in ("fname", "diffnames", "history", "watch",
+            "queries", "usecache", "useindex", "balances", "validate",
+            "reconcile", "duplicates", "fuzzy", "http", "resultcache")
+            if opts[m]]
+        # 0 is a good -progressfd and -sumto, so those are
+        # False when not given.
+        bad += [m for m in ("progressfd", "sumto") if opts[m] is not False]
+        if bad:
+            print(label)
+            usage("Only search and report options are allowed"\
+                " in a -queries line")
+        querylist += [(label, makesearchterms(opts), outpath)]
+    return querylist
+
+
+def printqueryreports(querylist, foundlists, fname):
+    """Print each query's report, to its -o file if it has one.
+    When some query writes -format jsonl or csv records to
+    stdout the query labels go to stderr, out of their way."""
+    labelout = sys.stdout
+    for (label, st, outpath) in querylist:
+        if st._outformat != "text" and not outpath:
+            labelout = sys.stderr
+    for (k, (label, st, outpath)) in enumerate(querylist):
+        # Put back the marks this query's search made.
+        for w in foundlists[k]:
+            w.clearmatch()
+            searchmatches(w, st)
+        if outpath:
+            with open(outpath, "w") as f:
+                st.stermsprint(fname, f)
+                printfound(foundlists[k], st, f)
+            print("%s: %d transactions written to %s" %
+                (label, len(foundlists[k]), outpath), file=labelout)
+            continue
+        if label:
+            print("", file=labelout)
+            print(label, file=labelout)
+            st.stermsprint(fname)
+        printfound(foundlists[k], st)
+
+
+def runqueries(translist, tindex, querylist):
+    """Search the book once for all the queries.
+    Each transaction is tried against every query it
+    could match, in a single pass over the book.
+    Returns a list of found transactions per query."""
+    cands = []
+    aindex = None
+    for (label, st, outpath) in querylist:
+        if st.amountselected() and aindex is None:
+            aindex = amount_index(translist)
+        cands += [querycandidates(translist, st, tindex, aindex)]
+    foundlists = [[] for q in querylist]
+    for (i, w) in enumerate(translist):
+        for (k, (label, st, outpath)) in enumerate(querylist):
+            c = cands[k]
+            if c is not None and i not in c:
+                continue
+            w.clearmatch()
+            if searchmatches(w, st) == "y":
+                foundlists[k] += [w]
+    return foundlists
+
+
+class balance_index:
+    """Prefix sums of split values, in cents.
+    For each account its own splits in report order
+    (posted, entered, split guid) with the running total,
+    so a split's true running balance is one bisect.
+    For each account the splits of it and all its
+    subaccounts by posted date with the running total,
+    so the as-of balance of any account or subtree
+    is one bisect too.
+    """
+    def __init__(self, acctdict, translist):
+        own = {}
+        for w in translist:
+            t = w._trans
+            for s in w._splits:
+                own.setdefault(s._acctguid, []).append(
+                    ((t._dateposted, t._dateentered, s._guid), s._cents))
+        tree = {}
+        for (guid, lst) in own.items():
+            g = guid
+            depth = 0
+            while g != "" and g in acctdict and depth < 100:
+                tree.setdefault(g, []).extend(
+                    [(k[0][0:10], c) for (k, c) in lst])
+                g = acctdict[g][2]
+                depth = int(depth) + 1
+        self._own = {}
+        # The posted dates of _own's keys, for asof().
+        self._owndates = {}
+        for (guid, lst) in own.items():
+            self._own[guid] = prefixsums(lst)
+            self._owndates[guid] = [k[0][0:10] for k in self._own[guid][0]]
+        self._tree = {}
+        for (guid, lst) in tree.items():
+            self._tree[guid] = prefixsums(lst)
+
+    def runningbalance(self, trans, split):
+        (keys, sums) = self._own.get(split._acctguid, ([], []))
+        k = bisect.bisect_right(keys,
+            (trans._dateposted, trans._dateentered, split._guid))
+        if k == 0:
+            return 0
+        return sums[k-1]
+
+    def asof(self, guid, d, subtree):
+        """Balance through the end of date d (which may be
+        partial, 2022 meaning all of 2022)."""
+        (k, sums) = self.asofsplits(guid, d, subtree)
+        if k == 0:
+            return 0
+        return sums[k-1]
+
+    def asofsplits(self, guid, d, subtree):
+        """The number of splits through the end of date d,
+        and the running totals."""
+        if subtree:
+            (keys, sums) = self._tree.get(guid, ([], []))
+        else:
+            keys = self._owndates.get(guid, [])
+            sums = self._own.get(guid, ([], []))[1]
+        # Any date starting with d sorts before d + "\uffff".
+        return (bisect.bisect_right(keys, d + "\uffff"), sums)
+
+
+class split_balances:
+    """The running balances of some splits, by split guid,
+    as a balance_index gave them, for a report printed away
+    from the book (a multi-book search)."""
+    def __init__(self, balances):
+        self._balances = balances
+
+    def runningbalance(self, trans, split):
+        return self._balances.get(split._guid, 0)
+
+
+def prefixsums(lst):
+    """Sorted keys and running totals of [(key, cents)]"""
+    lst.sort(key=lambda x: x[0])
+    keys = []
+    sums = []
+    tot = 0
+    for (k, c) in lst:
+        tot += c
+        keys += [k]
+        sums += [tot]
+    return (keys, sums)
+
+
+def printbalances(acctdict, translist, asofdate, st):
+    bindex = balance_index(acctdict, translist)
+    children = {}
+    roots = []
+    for (guid, (name, etype, pguid, ourguid)) in acctdict.items():
+        if etype == "ROOT":
+            roots += [guid]
+        else:
+            children.setdefault(pguid, []).append(guid)
+    if st._accountselect:
+        us = actic(st._accountselect, st)
+        roots = []
+        for guid in acctdict.keys():
+            full = actic(acctfullname(acctdict, guid), st)
+            short = actic(shortacctname(acctdict, guid), st)
+            if us == full or us == short:
+                roots += [guid]
+        if len(roots) == 0:
+            print("No account named", st._accountselect)
+            return
+    print("Balances as of end of", asofdate)
+    print("%-44s %13s %13s" % ("account", "balance", "with subaccts"))
+
+    def walk(guid, depth):
+        name = acctdict[guid][0]
+        if acctdict[guid][1] != "ROOT":
+            (n, sums) = bindex.asofsplits(guid, asofdate, True)
+            if n == 0 and depth > 0:
+                # No splits here or below.
+                return
+            tb = bindex.asof(guid, asofdate, True)
+            ob = bindex.asof(guid, asofdate, False)
+            label = "%s%s" % ("  " * depth, name)
+            print("%-44s %13s %13s" % (label, centsstr(ob),
+                centsstr(tb)))
+            depth = int(depth) + 1
+        kids = children.get(guid, [])
+        kids.sort(key=lambda g: acctdict[g][0])
+        for k in kids:
+            walk(k, depth)
+    for r in roots:
+        walk(r, 0)
+
+
+def shortacctname(acctdict, guid):
+    """The account name as the reports show it,
+    with at most one parent, see buildtrans()."""
+    (name, etype, pguid, ourguid) = acctdict[guid]
+    if pguid != "":
+        pname = acctdict[pguid][0]
+        if str(pname) != "Root Account":
+            return str(pname) + ":" + str(name)
+    return str(name)
+
+
+# Date forms banks use in statement downloads.
+STATEMENTDATES = ("%Y-%m-%d", "%m/%d/%Y", "%m/%d/%y", "%Y/%m/%d",
+    "%d %b %Y", "%b %d, %Y")
+
+
+def statementdate(t):
+    for fmt in STATEMENTDATES:
+        try:
+            return datetime.strptime(t.strip(), fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def statementcents(t):
+    """Integer cents of $1,234.56 or (12.34) or -12.34,
+    None if it is not an amount."""
+    t = t.strip().replace("$", "").replace(",", "").replace(" ", "")
+    neg = False
+    if t.startswith("(") and t.endswith(")"):
+        neg = True
+        t = t[1:-1]
+    if t == "":
+        return None
+    try:
+        d = Decimal(t)
+    except InvalidOperation:
+        return None
+    if not d.is_finite():
+        return None
+    c = int(d.quantize(Decimal("0.01")) * 100)
+    if neg:
+        return -c
+    return c
+
+
+def statementcolumn(header, names):
+    for (i, h) in enumerate(header):
+        for n in names:
+            if n in h:
+                return i
+    return None
+
+
+def readstatement(path):
+    """Return the rows [(line, date, cents, description)]
+    and the line numbers that could not be read.
+    The header row names the columns: one with date in its
+    name, and Amount or else Debit and Credit, and
+    Description, Payee or Memo if there is one."""
+    try:
+        f = open(path, "r", newline="", encoding="utf-8-sig")
+        lines = list(csv.reader(f))
+        f.close()
+    except (OSError, UnicodeDecodeError, csv.Error) as e:
+        print("Cannot read", path, e)
+        sys.exit(1)
+    rows = []
+    bad = []
+    header = None
+    for (n, l) in enumerate(lines):
+        if len(l) == 0 or "".join(l).strip() == "":
+            continue
+        if header is None:
+            header = [h.strip().lower() for h in l]
+            dcol = statementcolumn(header, ("date",))
+            acol = statementcolumn(header, ("amount",))
+            debcol = statementcolumn(header, ("debit",))
+            credcol = statementcolumn(header, ("credit",))
+            desccol = statementcolumn(header, ("description", "payee",
+                "memo", "details", "name"))
+            if dcol is None or (acol is None and
+                    (debcol is None or credcol is None)):
+                print("The first line of", path, "must name a date")
+                print("column and an amount (or debit and credit) column.")
+                sys.exit(1)
+            continue
+        line = int(n) + 1
+        l = l + [""] * (len(header) - len(l))
+        d = statementdate(l[dcol])
+        if acol is not None:
+            c = statementcents(l[acol])
+        else:
+            deb = statementcents(l[debcol]) or 0
+            cred = statementcents(l[credcol]) or 0
+            c = deb - cred
+            if l[debcol].strip() == "" and l[credcol].strip() == "":
+                c = None
+        if d is None or c is None:
+            bad += [line]
+            continue
+        descr = ""
+        if desccol is not None:
+            descr = l[desccol].strip()
+        rows += [(line, d, c, descr)]
+    return rows, bad
+
+
+def reconcile(translist, st, rows, window):
+    """Pair statement rows with splits of the -accountselect
+    account of the same amount posted within window days.
+    Splits and rows are hashed by amount, and within one
+    amount the closest dates are paired first.
+    Returns (matched [(row, book, days)], book only,
+    rows only, sign) where book entries are (date, cents,
+    wholetrans, split) and sign is -1 if the statement shows
+    amounts negated relative to the book."""
+    if len(rows) == 0:
+        return [], [], [], 1
+    us = actic(st._accountselect, st)
+    lo = date.fromordinal(min([r[1] for r in rows]).toordinal() - window)
+    hi = date.fromordinal(max([r[1] for r in rows]).toordinal() + window)
+    lotext = lo.isoformat()
+    hitext = hi.isoformat()
+    book = []
+    for w in translist:
+        posted = w._trans._dateposted[0:10]
+        if posted < lotext or posted > hitext:
+            continue
+        for s in w._splits:
+            if actic(s._acctname, st) == us:
+                book += [(date.fromisoformat(posted), s._cents, w, s)]
+    book.sort(key=lambda b: (b[0], b[2]._trans._dateentered, b[3]._guid))
+    bookby = {}
+    for (j, b) in enumerate(book):
+        bookby.setdefault(b[1], []).append(j)
+    # A card statement often shows charges as positive where
+    # the book has them negative. Take whichever matches more.
+    same = len([r for r in rows if r[2] in bookby])
+    negated = len([r for r in rows if -r[2] in bookby])
+    sign = 1
+    if negated > same:
+        sign = -1
+    pairs = []
+    for (i, r) in enumerate(rows):
+        js = bookby.get(sign * r[2], [])
+        # js is in date order.
+        dates = [book[j][0].toordinal() for j in js]
+        day = r[1].toordinal()
+        k = bisect.bisect_left(dates, day - window)
+        while k < len(js) and dates[k] <= day + window:
+            pairs += [(abs(dates[k] - day), i, js[k])]
+            k = int(k) + 1
+    pairs.sort()
+    rowused = set()
+    bookused = set()
+    matched = []
+    for (days, i, j) in pairs:
+        if i in rowused or j in bookused:
+            continue
+        rowused.add(i)
+        bookused.add(j)
+        matched += [(rows[i], book[j], days)]
+    matched.sort(key=lambda m: m[0][0])
+    bookonly = [b for (j, b) in enumerate(book) if j not in bookused]
+    rowsonly = [r for (i, r) in enumerate(rows) if i not in rowused]
+    return matched, bookonly, rowsonly, sign
+
+
+def bookdescr(w, s):
+    descr = w._trans._description
+    memo = s._memo
+    if memo != "":
+        descr = descr + " / " + memo
+    return descr
+
+
+def printreconcile(translist, st, path, window):
+    rows, bad = readstatement(path)
+    matched, bookonly, rowsonly, sign = reconcile(translist, st,
+        rows, window)
+    cols = ["status", "line", "statement_date", "book_date",
+        "amount_cents", "statement_description", "book_description",
+        "guid"]
+    records = []
+    for (r, b, days) in matched:
+        records += [("matched", r[0], r[1].isoformat(), b[0].isoformat(),
+            b[1], r[3], bookdescr(b[2], b[3]), b[2]._trans._tguid)]
+    for r in rowsonly:
+        records += [("statement", r[0], r[1].isoformat(), "",
+            sign * r[2], r[3], "", "")]
+    for b in bookonly:
+        records += [("book", "", "", b[0].isoformat(), b[1], "",
+            bookdescr(b[2], b[3]), b[2]._trans._tguid)]
+    for line in bad:
+        records += [("unreadable", line, "", "", "", "", "", "")]
+    if st._outformat == "jsonl":
+        for rec in records:
+            print(json.dumps(dict(zip(cols, rec))))
+        return
+    if st._outformat == "csv":
+        cw = csv.writer(sys.stdout, lineterminator="\n")
+        cw.writerow(cols)
+        for rec in records:
+            cw.writerow(rec)
+        return
+    print("Reconcile     :", path)
+    print("Window        :", window, "days")
+    if sign < 0:
+        print("The statement shows amounts negated; book amounts shown.")
+    print("Statement rows %d matched %d only on statement %d"
+        " only in book %d" % (len(rows), len(matched), len(rowsonly),
+        len(bookonly)))
+    if len(bad) > 0:
+        print("Unreadable statement lines:",
+            " ".join([str(b) for b in bad]))
+    if len(rowsonly) > 0:
+        print("")
+        print("Only on statement:")
+        for r in rowsonly:
+            print("  line %-5d %s %11s  %s" % (r[0], r[1].isoformat(),
+                centsstr(sign * r[2]), r[3]))
+    if len(bookonly) > 0:
+        print("")
+        print("Only in book:")
+        for b in bookonly:
+            print("  %s %11s  %s" % (b[0].isoformat(), centsstr(b[1]),
+                bookdescr(b[2], b[3])))
+    if len(matched) > 0:
+        print("")
+        print("Matched:")
+        for (r, b, days) in matched:
+            print("  line %-5d %s book %s %11s  %-25s %s" % (r[0],
+                r[1].isoformat(), b[0].isoformat(), centsstr(b[1]),
+                r[3][0:25], bookdescr(b[2], b[3])))
+
+
+def sumtocandidates(foundlist, st):
+    """The splits -sumto combines, [(cents, date, w, s)]:
+    those of the -accountselect account, else the splits
+    the search marked as matching, or all of them when
+    only the transaction matched, as wprint() shows them.
+    Transactions without a proper posted date are left out."""
+    us = False
+    if st._accountselect:
+        us = actic(st._accountselect, st)
+    cands = []
+    for w in sorted(foundlist):
+        try:
+            posted = date.fromisoformat(w._trans._dateposted[0:10])
+        except ValueError:
+            continue
+        marked = len(w.findmarkedsplits(st)) > 0
+        for s in w._splits:
+            if s._cents == 0:
+                continue
+            if us:
+                if actic(s._acctname, st) != us:
+                    continue
+            elif marked and not s._foundmatch:
+                continue
+            cands += [(s._cents, posted, w, s)]
+    return cands
+
+
+# Bounds on -sumto memory: combinations hashed, and found.
+SUMTOTABLE = 2000000
+SUMTOFOUND = 100000
+
+
+def sumto(cands, target, maxsize, maxtime):
+    """Return (combinations, complete) where each combination
+    is a sorted tuple of cands positions whose cents sum to
+    target, with at most maxsize splits.
+    Meet in the middle: every combination of exactly h =
+    maxsize//2 splits is hashed by its sum. A combination of
+    more than h splits is then a head (its first positions)
+    plus a hashed tail of h positions after the head,
+    so each is found once. Stops after maxtime seconds
+    or when the table or the answer gets too big."""
+    start = monotonic()
+    cents = [c[0] for c in cands]
+    n = len(cents)
+    h = max(1, maxsize // 2)
+    tails = {}
+    found = []
+    count = 0
+    for size in range(1, h + 1):
+        for c in itertools.combinations(range(n), size):
+            count = int(count) + 1
+            if (count & 0xfff) == 0 and (monotonic() - start > maxtime
+                    or count > SUMTOTABLE):
+                return found, False
+            total = sum(map(cents.__getitem__, c))
+            if total == target:
+                found += [c]
+            if size == h:
+                tails.setdefault(total, []).append(c)
+    for size in range(1, maxsize - h + 1):
+        for head in itertools.combinations(range(n), size):
+            count = int(count) + 1
+            if (count & 0xfff) == 0 and (monotonic() - start > maxtime
+                    or len(found) > SUMTOFOUND):
+                return found, False
+            ts = tails.get(target - sum(map(cents.__getitem__, head)))
+            if ts is None:
+                continue
+            last = head[-1]
+            for tail in ts:
+                if tail[0] > last:
+                    found += [head + tail]
+    return found, True
+
+
+def printsumto(foundlist, st, target, maxsize, maxtime):
+    cands = sumtocandidates(foundlist, st)
+    combos, complete = sumto(cands, target, maxsize, maxtime)
+    ranked = []
+    for c in combos:
+        days = [cands[i][1].toordinal() for i in c]
+        ranked += [(max(days) - min(days), len(c), min(days), c)]
+    ranked.sort()
+    shown = ranked[0:50]
+    cols = ["combination", "span_days", "posted", "amount_cents",
+        "account", "description", "guid"]
+    if st._outformat != "text":
+        cw = None
+        if st._outformat == "csv":
+            cw = csv.writer(sys.stdout, lineterminator="\n")
+            cw.writerow(cols)
+        for (n, (span, size, first, c)) in enumerate(ranked):
+            for i in c:
+                (cents, posted, w, sp) = cands[i]
+                rec = [int(n) + 1, span, posted.isoformat(), cents,
+                    sp._acctpath, bookdescr(w, sp), w._trans._tguid]
+                if cw:
+                    cw.writerow(rec)
+                else:
+                    print(json.dumps(dict(zip(cols, rec))))
+        return
+    print("Sum to        :", centsstr(target))
+    print("Candidates    : %d splits, combinations of up to %d" %
+        (len(cands), maxsize))
+    if not complete:
+        print("Stopped early (time or size limit), there may be more.")
+    print("Found %d combinations" % len(ranked), end='')
+    if len(ranked) > len(shown):
+        print(", the first %d shown" % len(shown), end='')
+    print(", closest dates first.")
+    for (n, (span, size, first, c)) in enumerate(shown):
+        print("")
+        print("Combination %d: %d splits within %d days" %
+            (int(n) + 1, size, span))
+        for i in c:
+            (cents, posted, w, sp) = cands[i]
+            print("  %s %11s  %-25s %s" % (posted.isoformat(),
+                centsstr(cents), sp._acctpath[0:25], bookdescr(w, sp)))
+
+
+def dupdescr(d):
+    """The description with case, punctuation and
+    spacing differences removed."""
+    return " ".join("".join([c if c.isalnum() else " "
+        for c in d.lower()]).split())
+
+
+def dupkey(w):
+    """What two imports of one transaction share, apart
+    from the date: the description and the absolute
+    amount per account."""
+    amounts = sorted([(s._acctguid, abs(s._cents)) for s in w._splits])
+    return (dupdescr(w._trans._description), tuple(amounts))
+
+
+def duplicates(foundlist, window):
+    """Return clusters (lists of whole_transactions, in
+    date order) with the same dupkey() posted within window
+    days of another member. One pass: each transaction
+    is hashed with its date bucket of window+1 days, so
+    any partner is in its own or the previous bucket.
+    Transactions without a proper posted date are left out."""
+    width = int(window) + 1
+    translist = []
+    days = []
+    for w in sorted(foundlist):
+        try:
+            day = date.fromisoformat(w._trans._dateposted[0:10])
+        except ValueError:
+            continue
+        translist += [w]
+        days += [day.toordinal()]
+    parent = list(range(len(translist)))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    buckets = {}
+    for (i, w) in enumerate(translist):
+        day = days[i]
+        key = dupkey(w)
+        b = day // width
+        for nb in (b - 1, b):
+            for j in buckets.get((key, nb), []):
+                if abs(day - days[j]) <= window:
+                    parent[root(i)] = root(j)
+        buckets.setdefault((key, b), []).append(i)
+    groups = {}
+    for i in range(len(translist)):
+        groups.setdefault(root(i), []).append(translist[i])
+    clusters = [g for g in groups.values() if len(g) > 1]
+    clusters.sort()
+    return clusters
+
+
+def transtotal(w):
+    """The size of the transaction, the sum of its debits."""
+    return sum([s._cents for s in w._splits if s._cents > 0])
+
+
+def printduplicates(foundlist, st, window):
+    clusters = duplicates(foundlist, window)
+    cols = ["cluster", "guid", "posted", "entered", "amount_cents",
+        "description"]
+    if st._outformat != "text":
+        cw = None
+        if st._outformat == "csv":
+            cw = csv.writer(sys.stdout, lineterminator="\n")
+            cw.writerow(cols)
+        for (n, c) in enumerate(clusters):
+            for w in c:
+                t = w._trans
+                rec = [int(n) + 1, t._tguid, t._dateposted[0:10],
+                    isodate(t._dateentered), transtotal(w),
+                    t._description]
+                if cw:
+                    cw.writerow(rec)
+                else:
+                    print(json.dumps(dict(zip(cols, rec))))
+        return
+    print("Duplicates    : %d clusters, %d transactions, posted"
+        " within %d days" % (len(clusters),
+        sum([len(c) for c in clusters]), window))
+    for (n, c) in enumerate(clusters):
+        print("")
+        print("Cluster %d: %d transactions" % (int(n) + 1, len(c)))
+        for w in c:
+            t = w._trans
+            print("  p:%s e:%s %11s  %-30s %s" % (t._dateposted[0:10],
+                t._dateentered[0:10], centsstr(transtotal(w)),
+                t._description[0:30], t._tguid))
+
+
+def editdistance(a, b):
+    """Damerau-Levenshtein distance: a letter added, dropped
+    or changed, or two neighbours swapped, is one edit each.
+    The unrestricted form, as the restricted one (optimal
+    string alignment) is not a metric and the BK-tree needs
+    one."""
+    big = len(a) + len(b)
+    # d[i+1][j+1] is the distance of a[:i] and b[:j], with a
+    # border row and column of big.
+    d = [[big] * (len(b) + 2)]
+    for i in range(len(a) + 1):
+        d += [[big, i] + [0] * len(b)]
+    for j in range(len(b) + 1):
+        d[1][j + 1] = j
+    # letter -> last row of a it was in
+    lastrow = {}
+    for i in range(1, len(a) + 1):
+        lastcol = 0
+        for j in range(1, len(b) + 1):
+            k = lastrow.get(b[j - 1], 0)
+            l = lastcol
+            cost = 1
+            if a[i - 1] == b[j - 1]:
+                cost = 0
+                lastcol = j
+            d[i + 1][j + 1] = min(d[i][j] + cost, d[i + 1][j] + 1,
+                d[i][j + 1] + 1, d[k][l] + (i - k - 1) + 1 + (j - l - 1))
+        lastrow[a[i - 1]] = i
+    return d[len(a) + 1][len(b) + 1]
+
+
+class bk_tree:
+    """Words arranged by edit distance, so all words within
+    k of a word are found by visiting only the children
+    whose distance from their parent is within k of ours."""
+    def __init__(self, words):
+        self._root = None
+        # word -> {distance: child word}
+        self._kids = {}
+        for w in words:
+            self.add(w)
+
+    def add(self, word):
+        if self._root is None:
+            self._root = word
+            self._kids[word] = {}
+            return
+        node = self._root
+        while True:
+            d = editdistance(word, node)
+            if d == 0:
+                return
+            kids = self._kids[node]
+            if d not in kids:
+                kids[d] = word
+                self._kids[word] = {}
+                return
+            node = kids[d]
+
+    def query(self, word, k):
+        """Return [(distance, word)] within k of word."""
+        found = []
+        if self._root is None:
+            return found
+        todo = [self._root]
+        while len(todo) > 0:
+            node = todo.pop()
+            d = editdistance(word, node)
+            if d <= k:
+                found += [(d, node)]
+            for (kd, kid) in self._kids[node].items():
+                if d - k <= kd <= d + k:
+                    todo += [kid]
+        return found
+
+
+def fuzzywords(text):
+    return dupdescr(text).split()
+
+
+def fuzzylimit(word, distance):
+    """How many edits a word may have: -fuzzydistance if
+    given, else none for short words and more for long."""
+    if distance is not False:
+        return distance
+    if len(word) <= 2:
+        return 0
+    if len(word) <= 5:
+        return 1
+    return 2
+
+
+def fuzzydates(d):
+    """d with each pair of adjacent digits swapped."""
+    variants = set()
+    for i in range(len(d) - 1):
+        if d[i].isdigit() and d[i+1].isdigit() and d[i] != d[i+1]:
+            variants.add(d[0:i] + d[i+1] + d[i] + d[i+2:])
+    return variants
+
+
+def fuzzydatespan(d):
+    """The first and last day -d d means, when it is a
+    year, a month or a day, else None."""
+    try:
+        if len(d) == 4:
+            return date(int(d), 1, 1), date(int(d), 12, 31)
+        if len(d) == 7:
+            first = date(int(d[0:4]), int(d[5:7]), 1)
+            nextmonth = date.fromordinal(first.toordinal() + 31)
+            nextmonth = nextmonth.replace(day=1)
+            return first, date.fromordinal(nextmonth.toordinal() - 1)
+        if len(d) == 10:
+            first = date.fromisoformat(d)
+            return first, first
+    except ValueError:
+        return None
+    return None
+
+
+def fuzzyamounts(cents):
+    """Amounts one digit away from cents: a digit changed,
+    dropped or added, or two neighbours swapped."""
+    t = str(abs(cents))
+    digits = "0123456789"
+    variants = set()
+    for i in range(len(t)):
+        for c in digits:
+            variants.add(t[0:i] + c + t[i+1:])
+        variants.add(t[0:i] + t[i+1:])
+        if i + 1 < len(t):
+            variants.add(t[0:i] + t[i+1] + t[i] + t[i+2:])
+    for i in range(len(t) + 1):
+        for c in digits:
+            variants.add(t[0:i] + c + t[i:])
+    sign = 1
+    if cents < 0:
+        sign = -1
+    out = set()
+    for v in variants:
+        if v != "" and int(v) != abs(cents):
+            out.add(sign * int(v))
+    return out
+
+
+class fuzzy_search:
+    """Typo-tolerant matching. Each -s term matches as usual
+    (distance 0) or word by word against description and
+    memo words within an edit distance, found through a
+    BK-tree of the book's words. A -d date may be off by a
+    swapped digit pair (distance 1) or by up to days days
+    (distance in days). An -amount may be one digit off
+    (distance 1). The distances add up."""
+    def __init__(self, translist, st, distance, days):
+        self._st = st
+        self._days = days
+        # word -> set of translist positions
+        words = {}
+        for (i, w) in enumerate(translist):
+            for x in fuzzywords(w._trans._description):
+                words.setdefault(x, set()).add(i)
+            for sp in w._splits:
+                for x in fuzzywords(sp._memo):
+                    words.setdefault(x, set()).add(i)
+        tree = bk_tree(sorted(words.keys()))
+        # Per term, per term word, position -> distance.
+        self._terms = []
+        for term in st._printchecklist:
+            perword = []
+            for x in fuzzywords(term):
+                dist = {}
+                for (d, y) in tree.query(x, fuzzylimit(x, distance)):
+                    for i in words[y]:
+                        if d < dist.get(i, d + 1):
+                            dist[i] = d
+                perword += [dist]
+            self._terms += [perword]
+        self._dates = set()
+        self._span = None
+        if st._dateselected:
+            self._dates = fuzzydates(st._dateselected)
+            self._span = fuzzydatespan(st._dateselected)
+        self._amounts = set()
+        if st._amountlow is not False and st._amountlow == st._amounthigh:
+            self._amounts = fuzzyamounts(st._amountlow)
+
+    def datedistance(self, d):
+        if d.startswith(self._st._dateselected):
+            return 0
+        for v in self._dates:
+            if d.startswith(v):
+                return 1
+        if self._span and self._days > 0:
+            try:
+                day = date.fromisoformat(d[0:10]).toordinal()
+            except ValueError:
+                return None
+            (first, last) = self._span
+            off = max(first.toordinal() - day, day - last.toordinal())
+            if off <= self._days:
+                return off
+        return None
+
+    def match(self, i, w):
+        """Return the distance of w (at translist position i),
+        None if it does not match at all."""
+        st = self._st
+        t = w._trans
+        total = 0
+        if st._dateselected:
+            ds = []
+            if st._datetype != "entered":
+                ds += [self.datedistance(t._dateposted)]
+            if st._datetype != "posted":
+                ds += [self.datedistance(t._dateentered)]
+            ds = [d for d in ds if d is not None]
+            if len(ds) == 0:
+                return None
+            total += min(ds)
+        elif not st.dateinrange(t._dateposted, t._dateentered):
+            return None
+        marked = set()
+        if st.amountselected():
+            best = None
+            for (k, sp) in enumerate(w._splits):
+                c = sp._cents
+                d = None
+                if st.amountinrange(c):
+                    d = 0
+                elif c in self._amounts or \
+                        (st._amountabs and -c in self._amounts):
+                    d = 1
+                if d is not None:
+                    marked.add(k)
+                    if best is None or d < best:
+                        best = d
+            if best is None:
+                return None
+            total += best
+        if st._accountselect:
+            us = actic(st._accountselect, st)
+            found = False
+            for (k, sp) in enumerate(w._splits):
+                if actic(sp._acctname, st) == us:
+                    marked.add(k)
+                    found = True
+            if not found:
+                return None
+        fields = [actic(t._transactionnum, st), actic(t._description, st)]
+        for sp in w._splits:
+            fields += [actic(sp._memo, st), actic(sp._acctname, st),
+                actic(sp._value, st), actic(sp._chknum, st)]
+        for (n, term) in enumerate(st._searchchecklist):
+            if any([f.find(term) != -1 for f in fields]):
+                continue
+            perword = self._terms[n]
+            if len(perword) == 0:
+                return None
+            for dist in perword:
+                d = dist.get(i)
+                if d is None:
+                    return None
+                total += d
+        w.clearmatch()
+        t.markmatch()
+        for k in marked:
+            w._splits[k].markmatch()
+        return total
+
+    def search(self, translist):
+        """Return [(distance, whole_transaction)], closest first."""
+        found = []
+        for (i, w) in enumerate(translist):
+            d = self.match(i, w)
+            if d is not None:
+                found += [(d, w)]
+            if (i % 1000) == 999:
+                progress({"phase": "search", "transactions": i + 1,
+                    "matches": len(found)}, False)
+        found.sort(key=lambda x: (x[0], x[1]._trans))
+        return found
+
+
+def printfuzzy(ranked, st):
+    progress({"phase": "report", "matches": len(ranked)}, True)
+    if st._outformat != "text":
+        # Records come out in date order, see writerecords().
+        writerecords([w for (d, w) in ranked], st, False, True)
+        return
+    print("Transactions count", len(ranked), "closest first")
+    acctsumdict = {}
+    for (d, w) in ranked:
+        print("")
+        print("Distance", d, end='')
+        w.wprint("Match:", st, acctsumdict)
+
+
+# The library interface, for programs that import this file
+# rather than run it:
+#
+#   import searchgnucash
+#   book = searchgnucash.Book.open("/home/me/money.gnucash")
+#   for t in book.search(terms=["costco"], date="2022"):
+#       print(t.posted, t.description)
+#   print(book.totals(book.search(account="Groceries"),
+#       onlymatched=True))
+#
+# Nothing here prints or exits, bad arguments raise ValueError.
+# Records are plain named tuples in the field order of
+# transtorecord(), so sorted() puts them in date order.
+bookaccount = collections.namedtuple("bookaccount",
+    "guid name path type parent")
+booktransaction = collections.namedtuple("booktransaction",
+    "posted entered num description guid splits")
+booksplit = collections.namedtuple("booksplit",
+    "memo num value account accounttype guid cents accountguid"
+    " accountpath matched")
+
+
+def booksplitrecord(w, s):
+    return booksplit(s._memo, s._chknum, s._value, s._acctname,
+        s._accttype, s._guid, s._cents, s._acctguid, s._acctpath,
+        splitmatched(w, s))
+
+
+def booktransrecord(w):
+    t = w._trans
+    return booktransaction(t._dateposted, t._dateentered,
+        t._transactionnum, t._description, t._tguid,
+        tuple([booksplitrecord(w, s) for s in w._splits]))
+
+
+def flagarg(v, name):
+    """v as a bool, when it is one or 0 or 1, else a
+    ValueError, so that "false" does not mean True."""
+    if isinstance(v, bool):
+        return v
+    if isinstance(v, int) and v in (0, 1):
+        return v == 1
+    raise ValueError(name + " must be true or false")
+
+
+class Book:
+    """A book loaded once and searched any number of times.
+    acctdict, translist and tindex are what loadbook()
+    returns. Use Book.open() to make one."""
+    def __init__(self, path, acctdict, translist, tindex):
+        self.path = path
+        self.stamp = bookstamp(path)
+        self.acctdict = acctdict
+        self.translist = translist
+        self.tindex = tindex
+        # The amount_index, built by the first amount search.
+        self.aindex = None
+        self._balanceindex = None
+
+    @classmethod
+    def open(cls, path, usecache=False, useindex=False, parser="etree",
+        narrowto=None):
+        """Load the book at path, XML or sqlite, using the
+        -cache and -index files if asked. Given a searchterms
+        as narrowto, only the transactions that could match it
+        are loaded (see loadbook() prune), so the Book is good
+        for that one search only. Running balances need the
+        whole book, so then it is all loaded."""
+        if parser not in ("etree", "expat"):
+            raise ValueError("parser must be etree or expat")
+        st = narrowto
+        if st is None:
+            st = makesearchterms(parseargs([]))
+        prune = narrowto is not None and not narrowto.wantsbalances()
+        acctdict, translist, tindex = loadbook(path, 100, st,
+            usecache, useindex, prune, parser)
+        return cls(path, acctdict, translist, tindex)
+
+    @property
+    def accounts(self):
+        """Dict of guid to bookaccount, leaving out the root
+        accounts. path is the full name, like Expenses:Auto."""
+        accts = {}
+        for (guid, (name, etype, pguid, ourguid)) in self.acctdict.items():
+            if etype == "ROOT":
+                continue
+            accts[guid] = bookaccount(guid, name,
+                acctfullname(self.acctdict, guid), etype, pguid)
+        return accts
+
+    def findaccount(self, name):
+        """The guid of the account given by guid, full path
+        or (if only one account has it) plain name."""
+        if name in self.acctdict:
+            return name
+        found = []
+        for a in self.accounts.values():
+            if a.path == name:
+                return a.guid
+            if a.name == name:
+                found += [a.guid]
+        if len(found) == 1:
+            return found[0]
+        if len(found) == 0:
+            raise ValueError("No account " + name)
+        raise ValueError("Several accounts are named " + name +
+            ", use the full path")
+
+    def searchterms(self, terms=(), date=False, account=False,
+        amount=False, amountrange=False, absolute=False,
+        casesense=False, datetype=False):
+        """The searchterms for the arguments of search()."""
+        if isinstance(terms, str):
+            terms = [terms]
+        if not all([isinstance(t, str) for t in terms]):
+            raise ValueError("terms must be strings")
+        opts = parseargs([])
+        opts["searchtermlist"] = [t for t in terms if len(t) > 0]
+        if date:
+            if not isinstance(date, str) or not isdatetext(date):
+                raise ValueError("date is not YYYY, YYYY-MM or"
+                    " YYYY-MM-DD: " + str(date))
+            opts["dateselected"] = date
+        if datetype:
+            if datetype not in ("posted", "entered"):
+                raise ValueError("datetype must be posted or entered")
+            opts["datetype"] = datetype
+        if account is not False:
+            if not isinstance(account, str) or account == "":
+                raise ValueError("account must be an account name")
+            opts["accountselect"] = account
+        if amount is not False:
+            c = amountcents(amount)
+            if c is None:
+                raise ValueError("amount is not like 255.41: " +
+                    str(amount))
+            opts["amountlow"] = c
+            opts["amounthigh"] = c
+        elif amountrange is not False:
+            if not isinstance(amountrange, (tuple, list)) or \
+                    len(amountrange) != 2:
+                raise ValueError("amountrange must be (low, high)")
+            (low, high) = amountrange
+            for (k, a) in (("amountlow", low), ("amounthigh", high)):
+                if a is None:
+                    continue
+                c = amountcents(a)
+                if c is None:
+                    raise ValueError("amount is not like 255.41: " +
+                        str(a))
+                opts[k] = c
+            if not amountrangeok(opts["amountlow"], opts["amounthigh"]):
+                raise ValueError("amountrange needs a low or high end,"
+                    " and low no more than high")
+        opts["amountabs"] = flagarg(absolute, "absolute")
+        if flagarg(casesense, "casesense"):
+            opts["casesense"] = "y"
+        return makesearchterms(opts)
+
+    def matches(self, st, cancel=None):
+        """Yield each whole_transaction matching st, in book
+        order, marked as searchmatches() leaves it.
+        cancel, if given, is called every 1000 candidates and
+        the search stops when it returns true.
+        Sets the running balances the report of st shows."""
+        if st.wantsbalances():
+            st._balanceindex = self.balanceindex()
+        if st.amountselected() and self.aindex is None:
+            self.aindex = amount_index(self.translist)
+        positions = querycandidates(self.translist, st, self.tindex,
+            self.aindex)
+        if positions is None:
+            positions = range(len(self.translist))
+        else:
+            positions = sorted(positions)
+        found = 0
+        for (n, i) in enumerate(positions):
+            if (n % 1000) == 0:
+                if cancel is not None and cancel():
+                    return
+                progress({"phase": "search", "transactions": n,
+                    "matches": found}, False)
+            w = self.translist[i]
+            w.clearmatch()
+            if searchmatches(w, st) == "y":
+                found = int(found) + 1
+                yield w
+        progress({"phase": "search", "transactions": len(positions),
+            "matches": found}, True)
+
+    def search(self, terms=(), date=False, account=False,
+        amount=False, amountrange=False, absolute=False,
+        casesense=False, datetype=False):
+        """An iterator of a booktransaction for each match, in
+        book order, as the command line options would find them:
+        terms as -s (all must match), date as -d, account
+        as -accountselect, amount as -amount, amountrange
+        as -amount-range with (low, high) and None for an
+        open end, absolute as -abs, casesense as -case 1 and
+        datetype as -datetype. A split's matched says a
+        term, account or amount was found in it, or that
+        only the transaction matched, as the report shows.
+        Bad arguments raise ValueError here, the search
+        happens as the results are taken."""
+        st = self.searchterms(terms, date, account, amount,
+            amountrange, absolute, casesense, datetype)
+        return (booktransrecord(w) for w in self.matches(st))
+
+    def totals(self, transactions, by="account", onlymatched=False):
+        """Sum the split cents of transactions (as search()
+        yields them) by account path, or by the posted
+        month or year. All splits of a transaction sum to
+        0, so by month or year onlymatched is the useful
+        sum, say of the account searched for."""
+        if by not in ("account", "month", "year"):
+            raise ValueError("by must be account, month or year")
+        sums = {}
+        for t in transactions:
+            for s in t.splits:
+                if onlymatched and not s.matched:
+                    continue
+                if by == "account":
+                    k = s.accountpath
+                elif by == "month":
+                    k = t.posted[0:7]
+                else:
+                    k = t.posted[0:4]
+                sums[k] = sums.get(k, 0) + s.cents
+        return sums
+
+    def balance(self, account, asof, subtree=True):
+        """The balance in cents of the account (see
+        findaccount()) through the end of asof, which may be
+        a year, month or day, including its subaccounts
+        unless subtree is False."""
+        if not isdatetext(asof):
+            raise ValueError("asof is not YYYY, YYYY-MM or"
+                " YYYY-MM-DD: " + str(asof))
+        guid = self.findaccount(account)
+        return self.balanceindex().asof(guid, asof, subtree)
+
+    def balanceindex(self):
+        """The balance_index of the book, built on first use."""
+        if self._balanceindex is None:
+            self._balanceindex = balance_index(self.acctdict,
+                self.translist)
+        return self._balanceindex
+
+
+def querykey(st):
+    """The searchterms selections as a plain tuple, the same
+    for searches that cannot differ in what they find
+    (-s terms in any order, 12.3 or 12.30)."""
+    return (tuple(sorted(st._printchecklist)), st._dateselected,
+        st._printallafter, st._datetype, st._casesense,
+        st._accountselect, st._amountlow, st._amounthigh,
+        st._amountabs)
+
+
+def bookdigest(fname):
+    """sha256 of the book file."""
+    h = hashlib.sha256()
+    with open(fname, "rb") as f:
+        while True:
+            b = f.read(1 << 20)
+            if not b:
+                break
+            h.update(b)
+    return h.hexdigest()
+
+
+# The -http request fields, each the name of the command line
+# option, and the Book.search() argument it becomes.
+HTTPFIELDS = {"s": "terms", "d": "date", "accountselect": "account",
+    "amount": "amount", "amount-range": "amountrange",
+    "abs": "absolute", "case": "casesense", "datetype": "datetype"}
+
+
+def httpsearchargs(q):
+    """Book.search() arguments for a -http request object
+    like {"s": ["Costco"], "d": "2022"}."""
+    if not isinstance(q, dict):
+        raise ValueError("The request must be a JSON object")
+    args = {}
+    for (k, v) in q.items():
+        if k not in HTTPFIELDS:
+            raise ValueError("Unknown field " + str(k))
+        if k in ("abs", "case"):
+            v = flagarg(v, k)
+        args[HTTPFIELDS[k]] = v
+    terms = args.get("terms", [])
+    if isinstance(terms, str):
+        terms = [terms]
+    if not isinstance(terms, list) or \
+            not all([isinstance(t, str) for t in terms]):
+        raise ValueError("s must be a string or list of strings")
+    args["terms"] = terms
+    r = args.get("amountrange", False)
+    if r is not False:
+        wds = str(r).split("..")
+        if len(wds) != 2:
+            raise ValueError("amount-range is not low..high: " + str(r))
+        args["amountrange"] = tuple([w.strip() or None for w in wds])
+    if args.get("datetype") == "both":
+        args["datetype"] = False
+    return args
+
+
+class query_service:
+    """The book for -http, reloaded when the file changes,
+    and the response bodies of the last cachesize searches,
+    keyed by the book's sha256 and querykey(), dropping the
+    least recently used first."""
+    def __init__(self, fname, usecache, useindex, parser, cachesize):
+        self._fname = fname
+        self._usecache = usecache
+        self._useindex = useindex
+        self._parser = parser
+        self._cachesize = cachesize
+        self._cache = collections.OrderedDict()
+        self._book = None
+        self._stamp = None
+        self._digest = ""
+        self._hits = 0
+        self._misses = 0
+        self.current()
+
+    def current(self):
+        """The Book, read again if the file changed."""
+        stamp = bookstamp(self._fname)
+        if self._book is None or stamp != self._stamp:
+            # The stamp and digest first: should GnuCash save
+            # the book while it is read, the next request
+            # sees a new stamp and reads it again.
+            digest = bookdigest(self._fname)
+            self._book = Book.open(self._fname, self._usecache,
+                self._useindex, self._parser)
+            self._stamp = stamp
+            self._digest = digest
+        return self._book
+
+    def search(self, q):
+        """The JSON response body (bytes) for request q."""
+        book = self.current()
+        st = book.searchterms(**httpsearchargs(q))
+        key = (self._digest, querykey(st))
+        body = self._cache.get(key)
+        if body is not None:
+            self._cache.move_to_end(key)
+            self._hits = int(self._hits) + 1
+            return body
+        self._misses = int(self._misses) + 1
+        found = sorted(book.matches(st))
+        body = json.dumps({"book": self._fname, "count": len(found),
+            "transactions": [recorddict(w) for w in found]})
+        body = body.encode("utf-8")
+        if self._cachesize > 0:
+            self._cache[key] = body
+            while len(self._cache) > self._cachesize:
+                self._cache.popitem(last=False)
+        return body
+
+    def status(self):
+        book = self.current()
+        return json.dumps({"book": self._fname,
+            "sha256": self._digest,
+            "transactions": len(book.translist),
+            "cached": len(self._cache), "cachesize": self._cachesize,
+            "hits": self._hits, "misses": self._misses}).encode("utf-8")
+
+
+class http_handler(http.server.BaseHTTPRequestHandler):
+    """POST /search with a JSON request, GET /status.
+    server.service is the query_service."""
+    def reply(self, code, body):
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def error(self, code, msg):
+        self.reply(code, json.dumps({"error": msg}).encode("utf-8"))
+
+    def do_GET(self):
+        if self.path != "/status":
+            self.error(404, "GET /status or POST /search")
+            return
+        try:
+            self.reply(200, self.server.service.status())
+        except (OSError, EOFError, ET.ParseError, sqlite3.Error) as e:
+            self.error(500, "Cannot read the book: " + str(e))
+
+    def do_POST(self):
+        if self.path != "/search":
+            self.error(404, "GET /status or POST /search")
+            return
+        try:
+            n = int(self.headers.get("Content-Length", 0))
+            if n < 0:
+                raise ValueError("Bad Content-Length")
+            q = json.loads(self.rfile.read(n) or b"{}")
+            body = self.server.service.search(q)
+        except (ValueError, InvalidOperation) as e:
+            # json.JSONDecodeError is a ValueError too.
+            self.error(400, str(e))
+            return
+        except (OSError, EOFError, ET.ParseError, sqlite3.Error) as e:
+            self.error(500, "Cannot read the book: " + str(e))
+            return
+        self.reply(200, body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def httpaddress(a):
+    """(host, port) from host:port, None if not like that."""
+    (host, sep, port) = a.rpartition(":")
+    if sep == "" or not port.isdigit() or int(port) > 65535:
+        return None
+    return (host, int(port))
+
+
+def servehttp(fname, address, usecache, useindex, parser, cachesize):
+    """Answer -http requests until Control-C. One request at
+    a time, as the searches mark the shared transactions."""
+    service = query_service(fname, usecache, useindex, parser,
+        cachesize)
+    server = http.server.HTTPServer(address, http_handler)
+    server.service = service
+    print("Serving", fname, "on http://%s:%d" % server.server_address[0:2],
+        flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+# The -resultcache files: the report of each search, kept
+# in ~/.cache/searchgnucash (or $XDG_CACHE_HOME/searchgnucash)
+# under a name made from the book's size, modification time
+# and sha256 and the normalized search and report options.
+# A file's modification time is its last use, and the least
+# recently used go when the files pass -resultcachesize.
+RESULTSUFFIX = ".sgout"
+
+
+def resultcachedir():
+    base = os.environ.get("XDG_CACHE_HOME", "")
+    if base == "":
+        base = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "searchgnucash")
+
+
+def resultcachepath(fname, st):
+    """The result cache file for this book and search."""
+    key = (CACHEVERSION, bookstamp(fname), bookdigest(fname),
+        querykey(st), st._outformat, st._csvformat,
+        st._onlytranslines, st._accountreport, st._printallsplits)
+    name = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+    return os.path.join(resultcachedir(), name + RESULTSUFFIX)
+
+
+def readresult(path):
+    """The cached report text, or None."""
+    try:
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            text = f.read()
+        # Mark it recently used.
+        os.utime(path)
+    except (OSError, UnicodeDecodeError):
+        return None
+    return text
+
+
+def writeresult(path, text, limit):
+    """Keep text at path, then remove the least recently
+    used results until all of them fit in limit bytes.
+    Failure to write is not fatal."""
+    tmp = path + ".tmp%d" % os.getpid()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, "w", encoding="utf-8", newline="") as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except OSError as e:
+        print("Unable to write", path, e, file=sys.stderr)
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        return
+    files = []
+    total = 0
+    with os.scandir(os.path.dirname(path)) as it:
+        for e in it:
+            if not e.name.endswith(RESULTSUFFIX):
+                continue
+            try:
+                sb = e.stat()
+            except OSError:
+                continue
+            files += [(sb.st_mtime_ns, e.path, sb.st_size)]
+            total += sb.st_size
+    files.sort()
+    for (t, p, size) in files:
+        if total <= limit or p == path:
+            break
+        try:
+            os.unlink(p)
+        except OSError:
+            pass
+        total -= size
+
+
+def quoted(s1, s2, s3):
+    q1 = "'" + str(hrutil.twodig(s1)) + "'"
+    q2 = "'" + str(hrutil.twodig(s2)) + "'"
+    q3 = "'" + str(hrutil.twodig(s3)) + "'"
+    return ",".join([q1, q2, q3])
+
+
+def validateindex(i, lim, m):
+    if int(i) < int(lim):
+        return
+    print("Improper argument list, missing value for ", m)
+    usage("")
+
+def reportallafter(d,msg):
+    print("The",msg,"date is not in YYYY-MM-DD form or")
+    print(" a proper subset of that.");
+    print("It is, instead:",d);
+    usage("Date Error!")
+def isdatetext(d):
+    """True if d is YYYY-MM-DD or a proper subset of it,
+    YYYY or YYYY-MM."""
+    wds = d.split("-")
+    if len(wds) > 3:
+        return False
+    w = wds[0]
+    if len(w) != 4 or not w.isdigit():
+        return False
+    for w in wds[1:]:
+        if len(w) != 2 or not w.isdigit():
+            return False
+    return True
+
+
+def validatedate(d,msg):
+    if not isdatetext(d):
+        reportallafter(d,msg)
+    return
+
+def reportamount(a,msg):
+    print("The",msg,"amount is not a number like 255.41")
+    print("It is, instead:",a)
+    usage("Amount Error!")
+
+def amountcents(a):
+    """The amount text as an int number of cents,
+    None if it is not an amount like 255.41"""
+    try:
+        d = Decimal(str(a).strip())
+        if not d.is_finite():
+            return None
+        # quantize() fails on amounts too large for cents.
+        if d != d.quantize(Decimal("0.01")):
+            return None
+    except InvalidOperation:
+        return None
+    return int(d * 100)
+
+
+def parseamount(a,msg):
+    """Return the amount text as an int number of cents"""
+    c = amountcents(a)
+    if c is None:
+        reportamount(a,msg)
+    return c
+
+def parseamountrange(r,msg):
+    """Return (low,high) cents from low..high, where
+    a missing end is False"""
+    wds = r.split("..")
+    if len(wds) != 2:
+        reportamount(r,msg)
+    low = False
+    high = False
+    if len(wds[0].strip()) > 0:
+        low = parseamount(wds[0],msg)
+    if len(wds[1].strip()) > 0:
+        high = parseamount(wds[1],msg)
+    if not amountrangeok(low,high):
+        reportamount(r,msg)
+    return low,high
+
+def amountrangeok(low,high):
+    """False for a range of cents with neither end given,
+    or with low above high."""
+    if low is False and high is False:
+        return False
+    if low is not False and high is not False and low > high:
+        return False
+    return True
+
+def readfor(f):
+    lall = f.readlines()
+    path = False
+    macos = False
+    for n,l in enumerate(lall):
+        l2 = l.strip()
+        if len(l2) < 1:
+            continue
+        if l2[0] == "#":
+            continue
+        if l2.startswith("filepath: "):
+            p=l2[10:]
+            p2 = p.strip()
+            if len(p2)  > 1:
+                path = p2;
+        if l2.startswith("macos:"):
+            macos = True
+    return path,macos
+ 
+#   Reading the configure file for a full path
+def readconf():
+    ghome= os.getenv("HOME",None)
+    if not ghome:
+        print("No HOME env variable available to find searchgnucash.conf")
+        return False,False
+    confpath= os.path.join(ghome,"searchgnucash.conf")
+    try:
+        f= open(confpath,"r")
+    except:
+        print("Cannot open",confpath)
+        return False,False
+    if not f:
+        print("Cannot open",confpath)
+        return False,False
+    path,macos= readfor(f)
+    f.close()
+    return path,macos 
+
+def parseargs(argv):
+    """Turn the argument list (without the program name)
+    into a dict of option values. Errors exit via usage()."""
+    searchtermlist = []
+    dateselected = False
+    datetype = False 
+    # Changed splits default 2020-02-09
+    printallsplits = True
+    printallafter = False
+    onlytranslines = False
+    accountselect = False
+    printacctnames = False
+    accountreport = False
+    csvformat = False
+    amountlow = False
+    amounthigh = False
+    amountabs = False
+    usecache = False
+    useindex = False
+    diffnames = False
+    history = False
+    validate = False
+    httpaddr = False
+    httpcache = 100
+    resultcache = False
+    resultcachesize = 50
+    watch = False
+    watchinterval = 2
+    queries = False
+    progressfd = False
+    outformat = "text"
+    parser = "etree"
+    shards = "year"
+    balances = False
+    reconcilepath = False
+    reconcilewindow = 3
+    sumtarget = False
+    dupes = False
+    fuzzy = False
+    fuzzydistance = False
+    fuzzydays = 3
+    dupwindow = 0
+    sumtosize = 4
+    sumtotime = 10
+    fname = False
+    fnames = []
+
+    casesense = "n"
+    ct = 0
+    while int(ct) < len(argv):
+        v = argv[ct]
+        if v == "-h":
+            usage("-h:")
+        if v == "-csv":
+            csvformat = True
+        elif v == "-cache":
+            usecache = True
+        elif v == "-index":
+            useindex = True
+        elif v == "-cacheshards":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-cacheshards")
+            shards = argv[ct]
+            if shards not in SHARDLENS:
+                usage("-cacheshards must be year or month")
+        elif v == "-resultcache":
+            resultcache = True
+        elif v == "-resultcachesize":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-resultcachesize")
+            if not argv[ct].isdigit():
+                usage("-resultcachesize needs a number of megabytes")
+            resultcachesize = int(argv[ct])
+        elif v == "-diff":
+            ct = int(ct) + 2
+            validateindex(ct, len(argv), "-diff")
+            diffnames = (argv[ct-1], argv[ct])
+        elif v == "-history":
+            history = True
+        elif v == "-validate":
+            validate = True
+        elif v == "-watch":
+            watch = True
+        elif v == "-http":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-http")
+            httpaddr = httpaddress(argv[ct])
+            if httpaddr is None:
+                usage("-http needs host:port, like 127.0.0.1:8080")
+        elif v == "-httpcache":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-httpcache")
+            if not argv[ct].isdigit():
+                usage("-httpcache needs a number of answers")
+            httpcache = int(argv[ct])
+        elif v == "-watchinterval":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-watchinterval")
+            try:
+                watchinterval = float(argv[ct])
+            except ValueError:
+                usage("-watchinterval needs a number of seconds")
+            if watchinterval <= 0:
+                usage("-watchinterval needs a number of seconds")
+        elif v == "-queries":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-queries")
+            queries = argv[ct]
+        elif v == "-progressfd":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-progressfd")
+            if not argv[ct].isdigit():
+                usage("-progressfd needs a file descriptor number")
+            progressfd = int(argv[ct])
+        elif v == "-format":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-format")
+            outformat = argv[ct]
+            if outformat not in ("text", "jsonl", "csv"):
+                usage("-format must be text, jsonl or csv")
+        elif v == "-parser":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-parser")
+            parser = argv[ct]
+            if parser not in ("etree", "expat"):
+                usage("-parser must be etree or expat")
+        elif v == "-reconcile":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-reconcile")
+            reconcilepath = argv[ct]
+        elif v == "-reconcilewindow":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-reconcilewindow")
+            if not argv[ct].isdigit():
+                usage("-reconcilewindow needs a number of days")
+            reconcilewindow = int(argv[ct])
+        elif v == "-sumto":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-sumto")
+            sumtarget = parseamount(argv[ct],"-sumto")
+        elif v == "-sumtosize":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-sumtosize")
+            if not argv[ct].isdigit() or int(argv[ct]) < 1:
+                usage("-sumtosize needs a number of splits")
+            sumtosize = int(argv[ct])
+        elif v == "-sumtotime":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-sumtotime")
+            try:
+                sumtotime = float(argv[ct])
+            except ValueError:
+                usage("-sumtotime needs a number of seconds")
+            if sumtotime <= 0:
+                usage("-sumtotime needs a number of seconds")
+        elif v == "-duplicates":
+            dupes = True
+        elif v == "-duplicatewindow":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-duplicatewindow")
+            if not argv[ct].isdigit():
+                usage("-duplicatewindow needs a number of days")
+            dupwindow = int(argv[ct])
+        elif v == "-fuzzy":
+            fuzzy = True
+        elif v == "-fuzzydistance":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-fuzzydistance")
+            if not argv[ct].isdigit():
+                usage("-fuzzydistance needs a number of edits")
+            fuzzydistance = int(argv[ct])
+        elif v == "-fuzzydays":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-fuzzydays")
+            if not argv[ct].isdigit():
+                usage("-fuzzydays needs a number of days")
+            fuzzydays = int(argv[ct])
+        elif v == "-balances":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-balances")
+            balances = argv[ct]
+            validatedate(balances,"-balances")
+        elif v == "-f":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-f")
+            # Any number of paths or patterns, up to the next option.
+            while True:
+                # A file named like a pattern is that file.
+                paths = [argv[ct]]
+                if not os.path.exists(argv[ct]):
+                    paths = sorted(glob.glob(argv[ct])) or paths
+                fnames += paths
+                if ct + 1 >= len(argv) or argv[ct+1].startswith("-"):
+                    break
+                ct = int(ct) + 1
+            fname = fnames[0]
+        elif v == "-datetype":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-datetype")
+            if len(argv[ct]) >= 1:
+                typed = argv[ct]
+                if typed == "posted":
+                    datetype = typed
+                elif typed == "entered":
+                    datetype = typed
+                elif typed == "both":
+                    datetype = False
+                else:
+                    print("-datetype arg is ",typed, " which isnot allowed")
+        elif v == "-case":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-case")
+            if len(argv[ct]) >= 1:
+                icval = argv[ct]
+                if int(icval) == 0:
+                    casesense = "n"
+                else:
+                    casesense = "y"
+        elif v == "-onlytranslines":
+            onlytranslines = "y"
+        elif v == "-printacctnames":
+            printacctnames = True
+        elif v == "-accountreport":
+            printallsplits = False
+            accountreport = True
+        elif v == "-accountselect":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-accountselect")
+            accountselect = argv[ct]
         elif v == "-allsplits":
             printallsplits = True
         elif v == "-allafter":
             ct = int(ct) + 1
-            validateindex(ct, len(sys.argv), "-allafter")
-            if len(sys.argv[ct]) >= 1:
-                printallafter = sys.argv[ct]
+            validateindex(ct, len(argv), "-allafter")
+            if len(argv[ct]) >= 1:
+                printallafter = argv[ct]
                 validatedate(printallafter,"-allafter")
         elif v == "-d":
             ct = int(ct) + 1
-            validateindex(ct, len(sys.argv), "-d")
-            if len(sys.argv[ct]) >= 1:
-                dateselected = sys.argv[ct]
+            validateindex(ct, len(argv), "-d")
+            if len(argv[ct]) >= 1:
+                dateselected = argv[ct]
                 validatedate(dateselected,"-d")
+        elif v == "-amount":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-amount")
+            amountlow = parseamount(argv[ct],"-amount")
+            amounthigh = amountlow
+        elif v == "-amount-range":
+            ct = int(ct) + 1
+            validateindex(ct, len(argv), "-amount-range")
+            amountlow,amounthigh = parseamountrange(argv[ct],\
+                "-amount-range")
+        elif v == "-abs":
+            amountabs = True
         elif v == "-s":
             ct = int(ct) + 1
-            validateindex(ct, len(sys.argv), "-s")
-            if len(sys.argv[ct]) >= 1:
-                searchtermlist += [sys.argv[ct]]
+            validateindex(ct, len(argv), "-s")
+            if len(argv[ct]) >= 1:
+                searchtermlist += [argv[ct]]
         else:
-            print("Got arg ", ct, sys.argv[ct])
+            print("Got arg ", int(ct)+1, argv[ct])
             usage("Something wrong with args")
             sys.exit(1)
         ct = int(ct) + 1
+    opts = {"searchtermlist": searchtermlist,
+        "dateselected": dateselected,
+        "datetype": datetype,
+        "printallsplits": printallsplits,
+        "printallafter": printallafter,
+        "onlytranslines": onlytranslines,
+        "accountselect": accountselect,
+        "printacctnames": printacctnames,
+        "accountreport": accountreport,
+        "csvformat": csvformat,
+        "amountlow": amountlow,
+        "amounthigh": amounthigh,
+        "amountabs": amountabs,
+        "usecache": usecache,
+        "useindex": useindex,
+        "diffnames": diffnames,
+        "history": history,
+        "validate": validate,
+        "http": httpaddr,
+        "httpcache": httpcache,
+        "resultcache": resultcache,
+        "resultcachesize": resultcachesize,
+        "watch": watch,
+        "watchinterval": watchinterval,
+        "queries": queries,
+        "progressfd": progressfd,
+        "outformat": outformat,
+        "balances": balances,
+        "parser": parser,
+        "shards": shards,
+        "reconcile": reconcilepath,
+        "reconcilewindow": reconcilewindow,
+        "sumto": sumtarget,
+        "duplicates": dupes,
+        "fuzzy": fuzzy,
+        "fuzzydistance": fuzzydistance,
+        "fuzzydays": fuzzydays,
+        "duplicatewindow": dupwindow,
+        "sumtosize": sumtosize,
+        "sumtotime": sumtotime,
+        "fname": fname,
+        "fnames": fnames,
+        "casesense": casesense}
+    return opts
+
+
+def makesearchterms(opts):
+    st = searchterms(
+        opts["searchtermlist"],
+        opts["dateselected"],
+        opts["casesense"],
+        opts["printallsplits"],
+        opts["printallafter"],
+        opts["onlytranslines"],
+        opts["accountselect"],
+        opts["printacctnames"],
+        opts["accountreport"],
+        opts["datetype"],opts["csvformat"],
+        opts["amountlow"],
+        opts["amounthigh"],
+        opts["amountabs"],
+        opts["outformat"]
+    )
+    return st
+
+
+if __name__ == "__main__":
+    opts = parseargs(sys.argv[1:])
+    fname = opts["fname"]
+    diffnames = opts["diffnames"]
+    if diffnames:
+        fname = " ".join(diffnames)
     if not fname:
         fname,macos = readconf()
         if not fname:
@@ -1207,23 +4884,137 @@ if __name__ == "__main__":
             print("Unable to continue.")
             sys.exit(1)
     #    sys.exit(1)
-    st = searchterms(
-        searchtermlist,
-        dateselected,
-        casesense,
-        printallsplits,
-        printallafter,
-        onlytranslines,
-        accountselect,
-        printacctnames,
-        accountreport,
-        datetype,csvformat
-    )
+    if opts["diffnames"] or opts["history"] or opts["watch"] or \
+            opts["validate"]:
+        for n in (diffnames or [fname]):
+            if issqlbook(n):
+                usage("-diff, -history, -watch and -validate"\
+                    " need an XML book")
+    if opts["progressfd"] is not False:
+        progresstofd(opts["progressfd"])
+    setshards(opts["shards"])
+    if len(opts["fnames"]) > 1:
+        for m in ("diffnames", "history", "watch", "validate", "queries",
+                "balances", "reconcile", "duplicates", "fuzzy",
+                "printacctnames", "http", "resultcache"):
+            if opts[m]:
+                usage("Only a plain search can use several books")
+        if opts["sumto"] is not False:
+            usage("Only a plain search can use several books")
+        st = makesearchterms(opts)
+        st.stermsprint(" ".join(opts["fnames"]))
+        failed = searchbooks(opts["fnames"], st, opts["usecache"],
+            opts["useindex"], opts["parser"])
+        if failed > 0:
+            sys.exit(1)
+        sys.exit(0)
+    if opts["reconcile"] and not opts["accountselect"]:
+        usage("-reconcile needs -accountselect")
+    st = makesearchterms(opts)
+    if opts["queries"]:
+        querylist = readqueries(opts["queries"])
+        if opts["watch"]:
+            try:
+                watchbook(fname, querylist, opts["watchinterval"])
+            except KeyboardInterrupt:
+                pass
+            sys.exit(0)
+        try:
+            book = Book.open(fname, opts["usecache"], opts["useindex"],
+                opts["parser"])
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        if st._printacctnames:
+            print_account_names(book.acctdict)
+        for (label, qst, outpath) in querylist:
+            if qst.wantsbalances():
+                qst._balanceindex = book.balanceindex()
+        foundlists = runqueries(book.translist, book.tindex, querylist)
+        printqueryreports(querylist, foundlists, fname)
+        sys.exit(0)
+    if opts["validate"]:
+        sys.exit(printvalidation(fname, validatebook(fname), st))
+    if opts["http"]:
+        try:
+            servehttp(fname, opts["http"], opts["usecache"],
+                opts["useindex"], opts["parser"], opts["httpcache"])
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
     st.stermsprint(fname)
-    f = gzip.open(fname, "rb")
-    content = f.read()
-    f.close
+    if diffnames:
+        diffbooks(diffnames[0], diffnames[1], st)
+        sys.exit(0)
+    if opts["history"]:
+        historybooks(fname, st)
+        sys.exit(0)
+    if opts["watch"]:
+        try:
+            watchbook(fname, [("", st, False)], opts["watchinterval"])
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+    rpath = False
+    if opts["resultcache"]:
+        for m in ("balances", "reconcile", "duplicates", "fuzzy",
+                "printacctnames"):
+            if opts[m]:
+                usage("-resultcache is for plain searches only")
+        if opts["sumto"] is not False:
+            usage("-resultcache is for plain searches only")
+        rpath = resultcachepath(fname, st)
+        text = readresult(rpath)
+        if text is not None:
+            sys.stdout.write(text)
+            progress({"phase": "done", "cached": True}, True)
+            sys.exit(0)
     # Here we read the account data and do the searches
     # and print our findings, if any.
-    getxml(content, 100, st)
+    # Balances and reconciling need every split, and -fuzzy
+    # dates and terms reach past what the options say, so
+    # only plain searches fetch just the candidate transactions.
+    narrow = not opts["balances"] and not opts["reconcile"] and \
+        not opts["fuzzy"]
+    try:
+        book = Book.open(fname, opts["usecache"], opts["useindex"],
+            opts["parser"], st if narrow else None)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    acctdict = book.acctdict
+    translist = book.translist
+    if st._printacctnames:
+        print_account_names(acctdict)
+    if opts["balances"]:
+        printbalances(acctdict, translist, opts["balances"], st)
+        sys.exit(0)
+    if opts["reconcile"]:
+        printreconcile(translist, st, opts["reconcile"],
+            opts["reconcilewindow"])
+        sys.exit(0)
+    if st.wantsbalances():
+        st._balanceindex = book.balanceindex()
+    if opts["fuzzy"]:
+        fz = fuzzy_search(translist, st, opts["fuzzydistance"],
+            opts["fuzzydays"])
+        printfuzzy(fz.search(translist), st)
+        sys.exit(0)
+    foundlist = list(book.matches(st))
+    if opts["duplicates"]:
+        printduplicates(foundlist, st, opts["duplicatewindow"])
+        sys.exit(0)
+    if opts["sumto"] is not False:
+        printsumto(foundlist, st, opts["sumto"], opts["sumtosize"],
+            opts["sumtotime"])
+        sys.exit(0)
+    if rpath:
+        out = io.StringIO()
+        printfound(foundlist, st, out)
+        text = out.getvalue()
+        sys.stdout.write(text)
+        writeresult(rpath, text, opts["resultcachesize"] * 1000000)
+    else:
+        printfound(foundlist, st)
+    progress({"phase": "done", "matches": len(foundlist)}, True)
     sys.exit(0)
@@ -0,0 +1,513 @@
+"""Tests for searchgnucash, on small books written by makebook().
+
+Run from the top directory with: python -m pytest tests
+"""
+import contextlib
+import hashlib
+import io
+import itertools
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import searchgnucash as sg
+
+
+# (name, type, parent name)
+ACCOUNTS = [("Root Account", "ROOT", ""),
+    ("Assets", "ASSET", "Root Account"),
+    ("Checking", "BANK", "Assets"),
+    ("Liabilities", "LIABILITY", "Root Account"),
+    ("Visa", "CREDIT", "Liabilities"),
+    ("Expenses", "EXPENSE", "Root Account"),
+    ("Groceries", "EXPENSE", "Expenses"),
+    ("Charity", "EXPENSE", "Expenses")]
+
+HEAD = """<?xml version="1.0" encoding="utf-8" ?>
+<gnc-v2 xmlns:gnc="http://www.gnucash.org/XML/gnc"
+ xmlns:act="http://www.gnucash.org/XML/act"
+ xmlns:book="http://www.gnucash.org/XML/book"
+ xmlns:split="http://www.gnucash.org/XML/split"
+ xmlns:trn="http://www.gnucash.org/XML/trn"
+ xmlns:ts="http://www.gnucash.org/XML/ts">
+<gnc:book version="2.0.0">
+"""
+
+
+def guid(*parts):
+    return hashlib.md5(repr(parts).encode()).hexdigest()
+
+
+def makebook(path, transactions):
+    """Write an XML book. transactions are (posted, description,
+    [(account, cents, memo)]), each posted like 2022-12-03."""
+    out = [HEAD]
+    for (name, etype, parent) in ACCOUNTS:
+        out += ["<gnc:account version=\"2.0.0\">\n"
+            "<act:name>%s</act:name>\n"
+            "<act:id type=\"guid\">%s</act:id>\n"
+            "<act:type>%s</act:type>\n" % (name, guid(name), etype)]
+        if parent:
+            out += ["<act:parent type=\"guid\">%s</act:parent>\n" %
+                guid(parent)]
+        out += ["</gnc:account>\n"]
+    for (n, (posted, descr, splits)) in enumerate(transactions):
+        out += ["<gnc:transaction version=\"2.0.0\">\n"
+            "<trn:id type=\"guid\">%s</trn:id>\n"
+            "<trn:date-posted><ts:date>%s 10:59:00 +0000</ts:date>"
+            "</trn:date-posted>\n"
+            "<trn:date-entered><ts:date>%s 12:00:00 +0000</ts:date>"
+            "</trn:date-entered>\n"
+            "<trn:description>%s</trn:description>\n<trn:splits>\n" %
+            (guid("t", n), posted, posted or "2000-01-01", descr)]
+        for (k, (acct, cents, memo)) in enumerate(splits):
+            out += ["<trn:split>\n<split:id type=\"guid\">%s</split:id>\n"
+                "<split:memo>%s</split:memo>\n"
+                "<split:value>%d/100</split:value>\n"
+                "<split:quantity>%d/100</split:quantity>\n"
+                "<split:account type=\"guid\">%s</split:account>\n"
+                "</trn:split>\n" % (guid("s", n, k), memo, cents, cents,
+                guid(acct))]
+        out += ["</trn:splits>\n</gnc:transaction>\n"]
+    out += ["</gnc:book>\n</gnc-v2>\n"]
+    with open(path, "w") as f:
+        f.write("".join(out))
+
+
+def spend(posted, descr, acct, cents, memo=""):
+    """A transaction paying cents to acct from Visa."""
+    return (posted, descr, [(acct, cents, memo), ("Visa", -cents, "")])
+
+
+class booktest(unittest.TestCase):
+    """Opens self.transactions as self.book."""
+    transactions = []
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "t.gnucash")
+        makebook(self.path, self.transactions)
+        self.book = sg.Book.open(self.path)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def st(self, *args):
+        return sg.makesearchterms(sg.parseargs(list(args)))
+
+
+class editdistancetest(unittest.TestCase):
+    def test_swap_is_one_edit(self):
+        self.assertEqual(sg.editdistance("joes", "jose"), 1)
+        self.assertEqual(sg.editdistance("ab", "ba"), 1)
+
+    def test_levenshtein_edits(self):
+        self.assertEqual(sg.editdistance("kitten", "sitting"), 3)
+        self.assertEqual(sg.editdistance("", "abc"), 3)
+        self.assertEqual(sg.editdistance("same", "same"), 0)
+
+    def test_metric(self):
+        # The BK-tree relies on the triangle inequality.
+        words = ["", "a", "ab", "ba", "ca", "ac", "abc", "cab", "bca"]
+        for x in words:
+            for y in words:
+                self.assertEqual(sg.editdistance(x, y),
+                    sg.editdistance(y, x))
+                for z in words:
+                    self.assertLessEqual(sg.editdistance(x, z),
+                        sg.editdistance(x, y) + sg.editdistance(y, z))
+
+    def test_fuzzylimit(self):
+        self.assertEqual(sg.fuzzylimit("ab", False), 0)
+        self.assertEqual(sg.fuzzylimit("joe", False), 1)
+        self.assertEqual(sg.fuzzylimit("joes", False), 1)
+        self.assertEqual(sg.fuzzylimit("trader", False), 2)
+        self.assertEqual(sg.fuzzylimit("ab", 3), 3)
+
+
+class fuzzytest(booktest):
+    transactions = [
+        spend("2022-12-03", "Trader Jose", "Groceries", 25957),
+        spend("2022-12-03", "Safeway", "Groceries", 25957),
+        spend("2022-12-03", "Trader Jxxs", "Groceries", 25957)]
+
+    def fuzzy(self, *args):
+        st = self.st(*args)
+        fz = sg.fuzzy_search(self.book.translist, st, False, False)
+        return [w._trans._description for (d, w) in
+            fz.search(self.book.translist)]
+
+    def test_swapped_letters_match(self):
+        self.assertEqual(self.fuzzy("-s", "trader joes"), ["Trader Jose"])
+
+    def test_short_word_allows_one_edit(self):
+        # "joes" to "jxxs" is two edits, past the limit of a
+        # four letter word.
+        self.assertNotIn("Trader Jxxs", self.fuzzy("-s", "trader joes"))
+
+    def test_short_words_must_be_exact(self):
+        self.assertEqual(self.fuzzy("-s", "xo"), [])
+
+
+class booksearchtest(booktest):
+    transactions = [
+        spend("2022-01-05", "Costco", "Groceries", 5000),
+        spend("2022-02-07", "Red Cross", "Charity", 2500),
+        spend("2023-01-09", "Costco", "Groceries", 1250)]
+
+    def test_search(self):
+        found = list(self.book.search(terms="costco", date="2022"))
+        self.assertEqual([t.posted[0:10] for t in found], ["2022-01-05"])
+
+    def test_matched_agrees_with_the_report(self):
+        # Matched on the description only: every split counts.
+        t = list(self.book.search(terms="red cross"))[0]
+        self.assertEqual([s.matched for s in t.splits], [True, True])
+        self.assertEqual(self.book.totals([t], onlymatched=True),
+            {"Expenses:Charity": 2500, "Liabilities:Visa": -2500})
+        t = list(self.book.search(account="Expenses:Groceries"))[0]
+        self.assertEqual([s.matched for s in t.splits], [True, False])
+
+    def test_account_totals(self):
+        found = self.book.search(account="Expenses:Groceries")
+        self.assertEqual(self.book.totals(found, by="year",
+            onlymatched=True), {"2022": 5000, "2023": 1250})
+
+    def test_marks_survive_records(self):
+        # Multi-book workers send records and marks, not objects.
+        st = self.st("-accountselect", "Expenses:Groceries")
+        for w in self.book.matches(st):
+            w2 = sg.recordtotrans(sg.transtorecord(w))
+            sg.setmarks(w2, sg.transmarks(w))
+            self.assertEqual([s._foundmatch for s in w2._splits],
+                [True, False])
+            self.assertEqual(sg.recorddict(w2), sg.recorddict(w))
+
+    def test_bad_arguments_raise_at_the_call(self):
+        for kw in ({"date": "22-01"}, {"amount": "12.3.4"},
+                {"datetype": "paid"}, {"absolute": "false"}):
+            with self.assertRaises(ValueError):
+                self.book.search(**kw)
+
+
+class balancetest(booktest):
+    transactions = [
+        spend("2022-01-05", "Costco", "Groceries", 5000),
+        spend("2022-02-07", "Red Cross", "Charity", 2500),
+        spend("2022-03-09", "Costco", "Groceries", 1250),
+        spend("2023-01-09", "Refund", "Groceries", -250)]
+
+    def test_running_balance_column(self):
+        st = self.st("-accountselect", "Expenses:Groceries",
+            "-accountreport")
+        found = list(self.book.matches(st))
+        bi = st._balanceindex
+        self.assertIsNotNone(bi)
+        running = [bi.runningbalance(w._trans, w._splits[0])
+            for w in found]
+        self.assertEqual(running, [5000, 6250, 6000])
+
+    def test_narrowed_book_still_has_every_balance(self):
+        st = self.st("-accountselect", "Expenses:Groceries",
+            "-accountreport", "-d", "2023")
+        book = sg.Book.open(self.path, narrowto=st)
+        w = list(book.matches(st))[0]
+        self.assertEqual(st._balanceindex.runningbalance(w._trans,
+            w._splits[0]), 6000)
+
+    def test_balance_rolls_up_subaccounts(self):
+        self.assertEqual(self.book.balance("Expenses", "2022"), 8750)
+        self.assertEqual(self.book.balance("Expenses", "2022-01"), 5000)
+        self.assertEqual(self.book.balance("Expenses", "2023"), 8500)
+        self.assertEqual(self.book.balance("Expenses", "2023", False), 0)
+        self.assertEqual(self.book.balance("Liabilities:Visa", "2023"),
+            -8500)
+
+
+class httpargstest(booktest):
+    transactions = [spend("2022-01-05", "Costco", "Groceries", 5000)]
+
+    def searchterms(self, q):
+        return self.book.searchterms(**sg.httpsearchargs(q))
+
+    def test_fields(self):
+        st = self.searchterms({"s": "costco", "d": "2022",
+            "amount-range": "10..60", "abs": True})
+        self.assertEqual(st._printchecklist, ["costco"])
+        self.assertEqual((st._amountlow, st._amounthigh), (1000, 6000))
+        self.assertTrue(st._amountabs)
+        st = self.searchterms({"amount-range": "..60"})
+        self.assertEqual((st._amountlow, st._amounthigh), (False, 6000))
+
+    def test_bad_requests(self):
+        for q in ({"amount-range": "5..1"}, {"amount-range": ".."},
+                {"amount-range": "1..2..3"}, {"amount": "12.345"},
+                {"accountselect": ["Expenses", "Groceries"]},
+                {"accountselect": 3}, {"s": [1]}, {"abs": "false"},
+                {"case": 2}, {"d": "2022-1"}, {"datetype": "paid"},
+                {"nosuch": 1}, ["not", "an", "object"]):
+            with self.assertRaises(ValueError):
+                self.searchterms(q)
+
+    def test_querykey_ignores_term_order_and_amount_form(self):
+        a = self.searchterms({"s": ["a", "b"], "amount": "12.3"})
+        b = self.searchterms({"s": ["b", "a"], "amount": "12.30"})
+        self.assertEqual(sg.querykey(a), sg.querykey(b))
+        c = self.searchterms({"s": ["b", "a"], "amount": "12.31"})
+        self.assertNotEqual(sg.querykey(a), sg.querykey(c))
+
+
+class duplicatestest(booktest):
+    transactions = [
+        spend("2022-01-05", "Costco", "Groceries", 5000),
+        spend("2022-01-07", "COSTCO.", "Groceries", 5000),
+        spend("2022-01-07", "Costco", "Groceries", 5001),
+        spend("2022-01-07", "Costco", "Charity", 5000),
+        spend("2022-01-20", "Costco", "Groceries", 5000),
+        spend("", "Costco", "Groceries", 5000)]
+
+    def clusters(self, window):
+        return [[w._trans._dateposted[0:10] for w in c]
+            for c in sg.duplicates(self.book.translist, window)]
+
+    def test_window(self):
+        self.assertEqual(self.clusters(0), [])
+        self.assertEqual(self.clusters(2), [["2022-01-05", "2022-01-07"]])
+        # Clusters chain through their members.
+        self.assertEqual(self.clusters(13),
+            [["2022-01-05", "2022-01-07", "2022-01-20"]])
+
+    def test_no_posted_date_is_left_out(self):
+        self.assertEqual(len(self.clusters(10000)), 1)
+
+
+class progresstest(unittest.TestCase):
+    def tearDown(self):
+        sg.setprogress(None)
+
+    def test_no_repeats(self):
+        sent = []
+        sg.setprogress(sent.append)
+        sg.progress({"phase": "read", "bytes": 10}, False)
+        sg.progress({"phase": "read", "bytes": 10}, True)
+        sg.progress({"phase": "read", "bytes": 20}, False)
+        sg.progress({"phase": "read", "bytes": 20}, True)
+        self.assertEqual(sent, [{"phase": "read", "bytes": 10},
+            {"phase": "read", "bytes": 20}])
+
+
+class difftest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.a = os.path.join(self.dir.name, "a.gnucash")
+        self.b = os.path.join(self.dir.name, "b.gnucash")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def diff(self, ta, tb):
+        makebook(self.a, ta)
+        makebook(self.b, tb)
+        out = io.StringIO()
+        st = sg.makesearchterms(sg.parseargs([]))
+        with contextlib.redirect_stdout(out):
+            sg.diffbooks(self.a, self.b, st)
+        return out.getvalue()
+
+    def test_added_removed_changed(self):
+        # guids come from the position, so the third is removed
+        # and the fourth added.
+        ta = [spend("2022-01-05", "Costco", "Groceries", 5000),
+            spend("2022-01-06", "Safeway", "Groceries", 2000),
+            spend("2022-01-07", "Red Cross", "Charity", 2500)]
+        tb = [spend("2022-01-05", "Costco", "Groceries", 5000),
+            spend("2022-01-06", "Safeway", "Groceries", 2100)]
+        out = self.diff(ta, tb)
+        self.assertIn("Transactions added 0 removed 1 changed 1"
+            " unchanged 1", out)
+        self.assertIn("Removed guid " + guid("t", 2), out)
+        self.assertIn("Changed guid " + guid("t", 1), out)
+        out = self.diff(tb, ta)
+        self.assertIn("added 1 removed 0 changed 1", out)
+
+    def test_order_does_not_matter(self):
+        ta = [spend("2022-01-05", "Costco", "Groceries", 5000),
+            spend("2022-01-06", "Safeway", "Groceries", 2000)]
+        makebook(self.a, ta)
+        with open(self.a) as f:
+            text = f.read()
+        (head, t0, t1) = text.split("<gnc:transaction ", 2)
+        t1, tail = t1.split("</gnc:book>")
+        with open(self.b, "w") as f:
+            f.write(head + "<gnc:transaction " + t1 + "<gnc:transaction "
+                + t0 + "</gnc:book>" + tail)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            sg.diffbooks(self.a, self.b,
+                sg.makesearchterms(sg.parseargs([])))
+        self.assertIn("added 0 removed 0 changed 0 unchanged 2",
+            out.getvalue())
+
+
+class amountindextest(booktest):
+    transactions = [spend("2022-01-%02d" % (1 + i % 28), "T%d" % i,
+        "Groceries", c) for (i, c) in enumerate(
+        [500, -500, 1234, 99, -1234, 0, 250000, 1235, 1233, -99])]
+
+    def brute(self, st):
+        return [i for (i, w) in enumerate(self.book.translist)
+            if any([st.amountinrange(s._cents) for s in w._splits])]
+
+    def test_lookups_match_a_scan(self):
+        index = sg.amount_index(self.book.translist)
+        for args in (["-amount", "12.34"], ["-amount", "5"],
+                ["-amount-range", "1..2500"], ["-amount-range", "..0"],
+                ["-amount-range", "-5..5"], ["-amount", "12.34", "-abs"],
+                ["-amount-range", "0.99..12.34", "-abs"],
+                ["-amount-range", "..1", "-abs"],
+                ["-amount-range", "-3..1", "-abs"]):
+            st = self.st(*args)
+            self.assertEqual(index.lookup(st), self.brute(st), args)
+
+
+class queryservicetest(booktest):
+    transactions = [spend("2022-01-05", "Costco", "Groceries", 5000),
+        spend("2022-02-05", "Safeway", "Groceries", 2000)]
+
+    def status(self, service):
+        return json.loads(service.status())
+
+    def test_cache_and_reload(self):
+        service = sg.query_service(self.path, False, False, "etree", 1)
+        body = json.loads(service.search({"s": "costco"}))
+        self.assertEqual(body["count"], 1)
+        self.assertEqual(body["transactions"][0]["description"], "Costco")
+        service.search({"s": ["costco"]})
+        self.assertEqual(self.status(service)["hits"], 1)
+        # A cache of one: safeway pushes costco out.
+        service.search({"s": "safeway"})
+        service.search({"s": "costco"})
+        self.assertEqual(self.status(service)["misses"], 3)
+        # A changed book is read again and not answered from cache.
+        makebook(self.path, self.transactions + [spend("2022-03-05",
+            "Costco", "Groceries", 100)])
+        os.utime(self.path, (1, 1))
+        body = json.loads(service.search({"s": "costco"}))
+        self.assertEqual(body["count"], 2)
+
+
+class bloomtest(unittest.TestCase):
+    def test_no_false_negatives(self):
+        triset = set()
+        for word in ("costco wholesale", "trader joes", "pg&e bill"):
+            sg.trigrams(sg.indexfold(word), triset)
+        bloom = sg.bloommake(triset)
+        for tri in triset:
+            self.assertTrue(sg.bloomhas(bloom, tri))
+        self.assertTrue(sg.bloomblock(bloom, [triset]))
+
+    def test_misses_most_absent_trigrams(self):
+        triset = set(["abc", "bcd", "cde"])
+        bloom = sg.bloommake(triset)
+        absent = ["%03d" % i for i in range(1000)]
+        hits = [t for t in absent if sg.bloomhas(bloom, t)]
+        self.assertLess(len(hits), 50)
+
+
+class sumtotest(unittest.TestCase):
+    def brute(self, cents, target, maxsize):
+        found = set()
+        for size in range(1, maxsize + 1):
+            for c in itertools.combinations(range(len(cents)), size):
+                if sum([cents[i] for i in c]) == target:
+                    found.add(c)
+        return found
+
+    def test_matches_brute_force(self):
+        cents = [100, 250, 350, -100, 600, 250, 75, 25, 500]
+        cands = [(c, None, None, None) for c in cents]
+        for target in (600, 350, 100, 0, 1000):
+            for maxsize in (1, 2, 3, 4, 5):
+                (found, complete) = sg.sumto(cands, target, maxsize, 60)
+                self.assertTrue(complete)
+                self.assertEqual(len(found), len(set(found)))
+                self.assertEqual(set(found),
+                    self.brute(cents, target, maxsize), (target, maxsize))
+
+
+class resultcachetest(booktest):
+    transactions = [spend("2022-01-05", "Costco", "Groceries", 5000)]
+
+    def setUp(self):
+        booktest.setUp(self)
+        self.oldcache = os.environ.get("XDG_CACHE_HOME")
+        os.environ["XDG_CACHE_HOME"] = self.dir.name
+
+    def tearDown(self):
+        if self.oldcache is None:
+            del os.environ["XDG_CACHE_HOME"]
+        else:
+            os.environ["XDG_CACHE_HOME"] = self.oldcache
+        booktest.tearDown(self)
+
+    def test_key(self):
+        p = sg.resultcachepath(self.path, self.st("-s", "a", "-s", "b"))
+        self.assertEqual(p, sg.resultcachepath(self.path,
+            self.st("-s", "b", "-s", "a")))
+        self.assertNotEqual(p, sg.resultcachepath(self.path,
+            self.st("-s", "a")))
+        self.assertNotEqual(p, sg.resultcachepath(self.path,
+            self.st("-s", "a", "-s", "b", "-format", "jsonl")))
+
+    def test_least_recently_used_go_first(self):
+        paths = [sg.resultcachepath(self.path, self.st("-s", t))
+            for t in ("a", "b", "c")]
+        for (k, p) in enumerate(paths):
+            sg.writeresult(p, "x" * 100, 1000)
+            os.utime(p, (k, k))
+        self.assertEqual(sg.readresult(paths[0]), "x" * 100)
+        # Reading a made it the most recently used, so b goes.
+        sg.writeresult(paths[2], "y" * 150, 300)
+        self.assertIsNone(sg.readresult(paths[1]))
+        self.assertEqual(sg.readresult(paths[0]), "x" * 100)
+        self.assertEqual(sg.readresult(paths[2]), "y" * 150)
+
+
+class loadtest(booktest):
+    transactions = [spend("%d-%02d-05" % (2019 + i % 4, 1 + i % 12),
+        ["Costco", "Safeway", "Red Cross"][i % 3],
+        ["Groceries", "Groceries", "Charity"][i % 3], 100 + i,
+        "memo %d" % i) for i in range(300)] + [
+        spend("", "No date", "Groceries", 1)]
+
+    def found(self, book, st):
+        # The -cache shards put the book in year order.
+        return sorted([sg.recorddict(w) for w in book.matches(st)],
+            key=lambda r: r["guid"])
+
+    def test_every_way_finds_the_same(self):
+        searches = [self.st("-s", "costco"), self.st("-d", "2021-03"),
+            self.st("-s", "memo 1", "-d", "2020"),
+            self.st("-amount-range", "1.50..2.00"),
+            self.st("-accountselect", "Expenses:Charity", "-d", "2022")]
+        for st in searches:
+            want = self.found(self.book, st)
+            self.assertGreater(len(want), 0)
+            for (cache, index, parser) in ((True, False, "etree"),
+                    (True, True, "etree"), (False, False, "expat"),
+                    (True, True, "expat")):
+                # Twice: writing the cache, then reading it.
+                for n in range(2):
+                    book = sg.Book.open(self.path, cache, index, parser)
+                    self.assertEqual(self.found(book, st), want)
+                    book = sg.Book.open(self.path, cache, index, parser,
+                        st)
+                    self.assertEqual(self.found(book, st), want)
+
+
+if __name__ == "__main__":
+    unittest.main()